@@ -1,26 +1,51 @@
+from utils import startup
+startup.install()
+
 import argparse
+import csv
 from datetime import datetime as dt
 
-from sympy import Point
-from sympy.geometry import Line
-
 import sentinal
+from utils import http_client
 
 
 def starttime(day, hour, min):
     return (day - 1) * 375 + hour * 60 + min - 555
 
 
+def line_coefficients(x1, y1, x2, y2):
+    # a*x + b*y + c = 0 through both points, same convention as sympy's Line.coefficients
+    if x1 == x2:
+        return 1, 0, -x1
+    if y1 == y2:
+        return 0, 1, -y1
+    return y1 - y2, x2 - x1, x1 * y2 - y1 * x2
+
+
 def print_trigger(s, y1, y2, x2, d, h, m, crossing_below=False):
-    line = Line(Point(0, y1), Point(x2, y2))
-    print(line.equation())
-    x, y, c = line.coefficients
+    x, y, c = line_coefficients(0, y1, x2, y2)
+    print(f"{x}*x + {y}*y + {c} = 0")
     st = starttime(d, h, m)
     str = f"LastTradedPrice('NSE:{s}') - (({-1 * c} + {-1 * x}*((YearDay() - 1) * 375 + (Math_Min(930, (Hour() * 60 + Minute())) - 555) - {st})) / {y}) {'<' if crossing_below else '>'} 0"
 
     return str
 
 
+def trigger_name(symbol, down=False):
+    return f"{symbol}_{'Down' if down else 'UP'}"
+
+
+def read_trendlines(path):
+    # csv columns: symbol, y1, y2, x2, day, hour, minute, direction (up/down), optional name
+    with open(path) as file:
+        for row in csv.DictReader(file):
+            down = row.get('direction', 'up').strip().lower() == 'down'
+            symbol = row['symbol'].strip().upper()
+            rule = print_trigger(symbol, int(row['y1']), int(row['y2']), int(row['x2']),
+                                 int(row['day']), int(row['hour']), int(row['minute']), crossing_below=down)
+            yield (row.get('name') or trigger_name(symbol, down)), rule
+
+
 def init_parser():
     parser = argparse.ArgumentParser(description='Add Trend line Alert')
 
@@ -30,6 +55,9 @@ def init_parser():
     parser.add_argument('-s', help="Symbol to add (NSE)")
     parser.add_argument("--coords", nargs="+", type=int)
     parser.add_argument("--start", nargs="+", type=int)
+    parser.add_argument(startup.FLAG, help="Report import time per module", action='store_true')
+    parser.add_argument('--batch', help="Csv of trendlines to add in one go")
+    parser.add_argument('--workers', help="Concurrent trigger creations", type=int, default=http_client.POOL_SIZE)
     return parser
 
 
@@ -37,17 +65,25 @@ if __name__ == '__main__':
     parser = init_parser()
     args = vars(parser.parse_args())
     print(args)
-    symbol = args['s'].upper()
-    y1, y2, x2 = args['coords']
-    x1 = 0
-    d, h, m = args['start']
-
-    dt.fromtimestamp(x1)
-    str = print_trigger(symbol, y1, y2, x2, d, h, m, crossing_below=(args['down']))
-    print(str)
-    name = f"{symbol}_{'Down' if args['down'] else 'UP'}"
     all_clear = args['clear']
     if all_clear:
         print(f'Clearing Triggers {all_clear}')
         sentinal.clear_triggers(all=all_clear)
-    sentinal.create_advanced_trigger_with_rule(str, name=name)
+
+    if args['batch']:
+        rules = list(read_trendlines(args['batch']))
+        created, failed = sentinal.bulk_create_rules(rules, workers=args['workers'])
+        print(f"Created {len(created)} trendline triggers, failed {len(failed)}")
+        for name in failed:
+            print(f"\t{name}")
+    else:
+        symbol = args['s'].upper()
+        y1, y2, x2 = args['coords']
+        x1 = 0
+        d, h, m = args['start']
+
+        dt.fromtimestamp(x1)
+        str = print_trigger(symbol, y1, y2, x2, d, h, m, crossing_below=(args['down']))
+        print(str)
+        name = trigger_name(symbol, args['down'])
+        sentinal.create_advanced_trigger_with_rule(str, name=name)
@@ -1,6 +1,8 @@
 import csv
 import sys
 
+from utils.instruments import tradingview_symbol
+
 
 with open(sys.argv[1]) as csv_file:
     csv_reader = csv.reader(csv_file, delimiter=',')
@@ -11,6 +13,6 @@ with open(sys.argv[1]) as csv_file:
             line_count += 1
         else:
             if row and len(row) > 1:
-                s = row[0].replace(' ', '').replace('&', '_').replace('-', '_')
+                s = tradingview_symbol(row[0])
                 symbols.append(f"NSE:{s}")
     print(",".join(symbols))
\ No newline at end of file
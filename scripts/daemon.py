@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import socketserver
+import threading
+import time
+
+import alert_trendline
+import idea_sync_kite
+import sentinal
+from utils import browser_login, google_sheet, metrics, sheet_cache
+
+SOCKET_PATH = os.getenv('SUBMIT_SOCKET', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.cache',
+                                                    'submit.sock'))
+# service account tokens last an hour, re-authorize the sheets client well before that
+SHEET_CLIENT_TTL = 30 * 60
+
+
+class WarmClients:
+    # authenticated clients kept across submissions
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sheet_cache = None
+        self._sheet_at = 0
+
+    def sheet_cache(self):
+        with self._lock:
+            if self._sheet_cache is None or time.time() - self._sheet_at > SHEET_CLIENT_TTL:
+                client, _, _ = google_sheet.init_google_sheet()
+                self._sheet_cache = sheet_cache.SheetCache(client)
+                self._sheet_at = time.time()
+            return self._sheet_cache
+
+    def warm(self, sheet=True):
+        sentinal.credentials.get()
+        idea_sync_kite.credentials.get()
+        if sheet:
+            self.sheet_cache().worksheet('Trade Log', 'Ideas')
+
+
+clients = WarmClients()
+
+
+def handle_idea(request):
+    # same switches as idea_sync_kite.py, e.g. {"s": "INFY", "e": "100-101", "sl": 95, "no_sheet": true}
+    args = vars(idea_sync_kite.init_parser().parse_args([]))
+    args.update({k: v for k, v in request.items() if k in args})
+    idea = idea_sync_kite.build_idea(args['s'], args['e'], args['sl'], args['ex'], args['mloss'], args['type'])
+    cache = None if args['no_sheet'] else clients.sheet_cache()
+    results = idea_sync_kite.run_sinks(idea_sync_kite.idea_sinks([idea], args, cache),
+                                       concurrent=not args['sequential'])
+    return {'idea': idea, 'sinks': results}
+
+
+def handle_trigger(request):
+    op = request.get('op', '>=')
+    return sentinal.create_trigger(request['symbol'].upper(), request['price'], op)
+
+
+def handle_trendline(request):
+    symbol = request['symbol'].upper()
+    y1, y2, x2 = request['coords']
+    d, h, m = request['start']
+    down = bool(request.get('down'))
+    rule = alert_trendline.print_trigger(symbol, y1, y2, x2, d, h, m, crossing_below=down)
+    return sentinal.create_advanced_trigger_with_rule(rule, name=alert_trendline.trigger_name(symbol, down))
+
+
+def handle_metrics(request):
+    # the run report so far; also refreshes the METRICS_REPORT / METRICS_PROM files
+    metrics.write(metrics.METRICS_REPORT, metrics.METRICS_PROM)
+    return metrics.registry.report()
+
+
+HANDLERS = {
+    'ping': lambda request: 'pong',
+    'metrics': handle_metrics,
+    'idea': handle_idea,
+    'trigger': handle_trigger,
+    'trendline': handle_trendline,
+}
+
+
+def dispatch(request):
+    start = time.perf_counter()
+    handler = HANDLERS.get(request.get('kind'))
+    try:
+        if handler is None:
+            raise ValueError(f"Unknown kind {request.get('kind')}")
+        response = {'ok': True, 'result': handler(request)}
+    except Exception as e:
+        response = {'ok': False, 'error': str(e)}
+    response['seconds'] = round(time.perf_counter() - start, 4)
+    metrics.observe('daemon_request_seconds', response['seconds'], kind=request.get('kind'), ok=response['ok'])
+    return response
+
+
+class SubmissionHandler(socketserver.StreamRequestHandler):
+    # one json request per line, one json response per line
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = dispatch(json.loads(line))
+            except ValueError as e:
+                response = {'ok': False, 'error': f"Bad request: {e}"}
+            self.wfile.write((json.dumps(response, default=str) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+def serve(path=SOCKET_PATH, warm_sheet=True):
+    if os.path.exists(path):
+        os.remove(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    clients.warm(sheet=warm_sheet)
+    with socketserver.ThreadingUnixStreamServer(path, SubmissionHandler) as server:
+        os.chmod(path, 0o600)
+        print(f"Listening on {path}")
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(path)
+
+
+def init_parser():
+    parser = argparse.ArgumentParser(description='Keep Kite, Sentinel and Sheets clients warm and take submissions.')
+    parser.add_argument('--socket', help="Unix socket path", default=SOCKET_PATH)
+    parser.add_argument('--no-sheet', help="Dont open the Trade Log sheet at startup", action='store_true')
+    parser.add_argument('--close-browser', help="Close Chromium after each login instead of keeping it for the next",
+                        action='store_true')
+    return parser
+
+
+if __name__ == '__main__':
+    args = vars(init_parser().parse_args())
+    browser_login.KEEP_BROWSER = not args['close_browser']
+    serve(args['socket'], warm_sheet=not args['no_sheet'])
@@ -0,0 +1,160 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from utils import universe
+
+# same defaults as pine_scripts/ema-bundle.pine
+LENGTHS = (20, 50, 200)
+SOURCES = {
+    'close': lambda c: c['close'],
+    'open': lambda c: c['open'],
+    'high': lambda c: c['high'],
+    'low': lambda c: c['low'],
+    'hl2': lambda c: (c['high'] + c['low']) / 2,
+    'hlc3': lambda c: (c['high'] + c['low'] + c['close']) / 3,
+    'ohlc4': lambda c: (c['open'] + c['high'] + c['low'] + c['close']) / 4,
+}
+
+
+def ema(values, length):
+    # Pine's ema: na for the first length - 1 bars, seeded with their sma, then
+    # alpha = 2 / (length + 1) recursion
+    values = np.asarray(values, dtype=float)
+    out = np.full(len(values), np.nan)
+    if len(values) < length:
+        return out
+    seeded = values[length - 1:].copy()
+    seeded[0] = values[:length].mean()
+    out[length - 1:] = pd.Series(seeded).ewm(alpha=2 / (length + 1), adjust=False).mean().to_numpy()
+    return out
+
+
+def load_candles(history_dir, symbol):
+    path = os.path.join(history_dir, f"{symbol}.csv")
+    if not os.path.exists(path):
+        return None
+    candles = pd.read_csv(path)
+    candles.columns = [c.strip().lower() for c in candles.columns]
+    return candles
+
+
+class EmaBundle:
+    # EMA state for many symbols kept in (symbols x lengths) arrays, so a new candle
+    # for one symbol, or for every symbol at once, is an O(1) update per symbol.
+    def __init__(self, symbols, lengths=LENGTHS):
+        self.symbols = list(symbols)
+        self.index = {s: i for i, s in enumerate(self.symbols)}
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.alpha = 2.0 / (self.lengths + 1)
+        shape = (len(self.symbols), len(self.lengths))
+        self.values = np.full(shape, np.nan)
+        self.seed_sum = np.zeros(shape)
+        self.count = np.zeros(len(self.symbols), dtype=np.int64)
+        self.last = np.full(len(self.symbols), np.nan)
+
+    def load_history(self, symbol, source_values):
+        # full-history computation with array math, then keep only the state needed to continue
+        i = self.index[symbol]
+        source_values = np.asarray(source_values, dtype=float)
+        n = len(source_values)
+        self.count[i] = n
+        self.last[i] = source_values[-1] if n else np.nan
+        for j, length in enumerate(self.lengths):
+            self.values[i, j] = ema(source_values, length)[-1] if n >= length else np.nan
+            self.seed_sum[i, j] = source_values[:length].sum()
+
+    def update(self, symbol, price):
+        self._update(np.array([self.index[symbol]]), np.array([price], dtype=float))
+        return self.values[self.index[symbol]]
+
+    def update_all(self, prices):
+        # prices: array aligned with self.symbols, nan for symbols without a new candle
+        prices = np.asarray(prices, dtype=float)
+        rows = np.flatnonzero(~np.isnan(prices))
+        self._update(rows, prices[rows])
+
+    def _update(self, rows, prices):
+        self.count[rows] += 1
+        self.last[rows] = prices
+        count = self.count[rows][:, None]
+        price = prices[:, None]
+        warming = count <= self.lengths
+        self.seed_sum[rows] += np.where(warming, price, 0.0)
+        current = self.values[rows]
+        stepped = self.alpha * price + (1 - self.alpha) * current
+        seeded = np.where(count == self.lengths, self.seed_sum[rows] / self.lengths, np.nan)
+        self.values[rows] = np.where(warming, seeded, stepped)
+
+    def frame(self):
+        data = {'close': self.last}
+        for j, length in enumerate(self.lengths):
+            data[f"ema{length}"] = self.values[:, j]
+        return pd.DataFrame(data, index=pd.Index(self.symbols, name='symbol'))
+
+    def save(self, path):
+        np.savez_compressed(path, symbols=np.array(self.symbols), lengths=self.lengths, values=self.values,
+                            seed_sum=self.seed_sum, count=self.count, last=self.last)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        bundle = cls(data['symbols'].tolist(), data['lengths'].tolist())
+        bundle.values, bundle.seed_sum = data['values'], data['seed_sum']
+        bundle.count, bundle.last = data['count'], data['last']
+        return bundle
+
+
+def screen(bundle):
+    table = bundle.frame()
+    emas = table[[c for c in table.columns if c.startswith('ema')]]
+    table['above_all'] = emas.lt(table['close'], axis=0).all(axis=1)
+    table['stacked'] = (emas.diff(axis=1).iloc[:, 1:] < 0).all(axis=1)
+    return table
+
+
+def build(symbols, history_dir, lengths=LENGTHS, source='close'):
+    bundle = EmaBundle(symbols, lengths)
+    for symbol in symbols:
+        candles = load_candles(history_dir, symbol)
+        if candles is not None and len(candles):
+            bundle.load_history(symbol, SOURCES[source](candles))
+    return bundle
+
+
+def init_parser():
+    parser = argparse.ArgumentParser(description='Screen a symbol universe against the EMA bundle.')
+    parser.add_argument('universe', help="Universe file from data/, e.g. FnO or ../data/NiftyBank.txt")
+    parser.add_argument('--history-dir', help="Directory of SYMBOL.csv candle files")
+    parser.add_argument('--lengths', nargs='+', type=int, default=list(LENGTHS))
+    parser.add_argument('--source', choices=list(SOURCES), default='close')
+    parser.add_argument('--state', help="Load/save EMA state here (.npz)")
+    parser.add_argument('--candles', help="Csv of new candles (symbol + ohlc columns) to apply to the saved state")
+    parser.add_argument('--above', help="Only show symbols trading above every EMA", action='store_true')
+    return parser
+
+
+if __name__ == '__main__':
+    args = vars(init_parser().parse_args())
+    symbols = universe.load_symbols(args['universe'])
+    if args['state'] and os.path.exists(args['state']) and not args['history_dir']:
+        bundle = EmaBundle.load(args['state'])
+    else:
+        bundle = build(symbols, args['history_dir'] or '.', args['lengths'], args['source'])
+
+    if args['candles']:
+        candles = pd.read_csv(args['candles'])
+        candles.columns = [c.strip().lower() for c in candles.columns]
+        for row in candles.assign(price=SOURCES[args['source']](candles)).itertuples():
+            if row.symbol in bundle.index:
+                bundle.update(row.symbol, row.price)
+
+    if args['state']:
+        bundle.save(args['state'])
+
+    table = screen(bundle)
+    if args['above']:
+        table = table[table['above_all']]
+    print(table.round(2).to_string())
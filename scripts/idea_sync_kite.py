@@ -1,19 +1,27 @@
+from utils import startup
+startup.install()
+
 import argparse
-import asyncio
+import csv
 import functools
 import math
-import pickle
 import os
-from utils import google_sheet
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import auth, browser_login, credential_store, google_sheet, http_client, instruments, sheet_cache, universe
 
-import requests
-from gspread.utils import numericise_all
-from pyppeteer import launch
-from requests.cookies import RequestsCookieJar
 from datetime import datetime, timedelta
 
+requests_cookies = startup.lazy_module('requests.cookies')
+rate_limit = startup.lazy_module('utils.rate_limit')
+
 KITE_URL = "https://kite.zerodha.com"
+# point at a local stand-in page to try the login flow
+KITE_LOGIN_URL = os.getenv('KITE_LOGIN_URL', KITE_URL)
 KITE_API_URL = "https://kite.zerodha.com/api"
+# holds the csrf token and decides when the stored login has expired
+SESSION_COOKIE = 'public_token'
 ZERODHA_USERID = os.getenv('ZERODHA_USERID')
 ZERODHA_PASSWORD = os.getenv("ZERODHA_PASSWORD")
 ZERODHA_PIN = os.getenv("ZERODHA_PIN")
@@ -24,27 +32,14 @@ WAITLIST = "Waitlist"
 LONG_TERM_IDEAS = "Long term ideas"
 
 
-def pickle_data(data):
-    with open('../auth_data/auth_data_kite.txt', 'wb') as file:
-        pickle.dump(data, file)
-
-
-def load_data():
-    # for reading also binary mode is important
-    try:
-        data = None
-        with open('../auth_data/auth_data_kite.txt', 'rb') as file:
-            data = pickle.load(file)
-        return data
-    except:
-        return None
+store = credential_store.CredentialStore('kite', SESSION_COOKIE, legacy='auth_data_kite.txt')
 
 
 def load_cookies(data):
     if not data:
         return None
 
-    jar = RequestsCookieJar()
+    jar = requests_cookies.RequestsCookieJar()
     if not isinstance(data, list):
         data = [data]
 
@@ -57,7 +52,7 @@ def load_cookies(data):
         value = c.pop('value', None)
         c = trim_cookie(c)
         jar.set(name, value, **c)
-        if name == 'public_token':
+        if name == SESSION_COOKIE:
             csrf_token = value
     return jar, csrf_token
 
@@ -71,40 +66,12 @@ def trim_cookie(c):
 
 
 async def sentinel_login():
-    browser = await launch(headless=True)
-    page = await browser.newPage()
-    await page.goto(KITE_URL)
-    await page.type("#userid", ZERODHA_USERID)
-    await page.type("#password", ZERODHA_PASSWORD)
-    await page.click("button[type='submit'")
-    await page.waitFor(5000)
-    await page.type("#pin", ZERODHA_PIN)
-    await page.click("button[type='submit'")
-    await page.waitForNavigation()
-    await page.waitFor(5000)
-    cookies = await page.cookies()
-    pickle_data(cookies)
-    await browser.close()
-
-
-def authenticate(f):
-    @functools.wraps(f)
-    def wrapper(*args, **kwargs):
-        def execute_fun():
-            auth_data = load_data()
-            if auth_data:
-                jar, csrf_token = load_cookies(auth_data)
-                resp = f(*args, auth_data=jar, csrf_token=csrf_token, **kwargs)
-                return resp
-            raise ZeroDivisionError
+    cookies = await browser_login.login('kite', KITE_LOGIN_URL, SESSION_COOKIE, ZERODHA_USERID, ZERODHA_PASSWORD, ZERODHA_PIN)
+    store.save(cookies)
 
-        try:
-            return execute_fun()
-        except ZeroDivisionError:
-            asyncio.get_event_loop().run_until_complete(sentinel_login())
-            return execute_fun()
 
-    return wrapper
+credentials = auth.CredentialCache(store, sentinel_login, load_cookies)
+authenticate = auth.authenticator(credentials)
 
 
 def process_response(resp):
@@ -116,6 +83,8 @@ def process_response(resp):
 
     if resp.status_code == 403:
         raise ZeroDivisionError
+    if resp.status_code in rate_limit.THROTTLE_CODES:
+        raise rate_limit.Throttled(resp)
 
 
 def make_headers(csrf_token=None, cookie_jar=None, **kwargs):
@@ -135,27 +104,39 @@ def make_headers(csrf_token=None, cookie_jar=None, **kwargs):
     }
 
 
+def kite_session(csrf_token, cookie_jar):
+    return http_client.bind_auth(http_client.get_session('kite'), getattr(cookie_jar, 'auth_generation', None),
+                                 lambda: (make_headers(csrf_token, cookie_jar), None))
+
+
 @authenticate
 def get_watchlists(auth_data=None, csrf_token=None, **kwargs):
-    resp = requests.get(f"{KITE_API_URL}/marketwatch", headers=make_headers(csrf_token, auth_data))
+    resp = kite_session(csrf_token, auth_data).get(f"{KITE_API_URL}/marketwatch")
     return process_response(resp)
 
 
 @authenticate
-def empty_watchlist(watchlist, auth_data=None, csrf_token=None, **kwargs):
-    id = watchlist.get('id')
-    status = True
-    for item in w.get('items', []):
-        resp = requests.delete(f"{KITE_API_URL}/marketwatch/{id}/{item.get('id')}",
-                               headers=make_headers(csrf_token, auth_data))
-        if not resp.ok:
-            status = False
+def remove_from_watchlist(watchlist, item, auth_data=None, csrf_token=None, **kwargs):
+    resp = kite_session(csrf_token, auth_data).delete(f"{KITE_API_URL}/marketwatch/{watchlist.get('id')}/{item.get('id')}")
+    if not resp.ok:
+        print(resp.text)
+    return resp.ok
 
-    return status
+
+def empty_watchlist(watchlist, workers=http_client.POOL_SIZE):
+    _, failed = run_concurrently(lambda item: remove_from_watchlist(watchlist, item),
+                                 watchlist.get('items', []), workers, rate_limit.LOW)
+    return not failed
+
+
+def add_to_watchlist(watchlist, symbol):
+    # validated before authenticate, so a typo never starts a browser login
+    symbol, _ = instruments.validate(symbol)
+    return post_watchlist_item(watchlist, symbol)
 
 
 @authenticate
-def add_to_watchlist(watchlist, symbol, auth_data=None, csrf_token=None, **kwargs):
+def post_watchlist_item(watchlist, symbol, auth_data=None, csrf_token=None, **kwargs):
     id = watchlist.get('id')
     data = {
         'segment': 'NSE',
@@ -163,45 +144,216 @@ def add_to_watchlist(watchlist, symbol, auth_data=None, csrf_token=None, **kwarg
         'watch_id': id,
         'weight': 0
     }
-    resp = requests.post(f"{KITE_API_URL}/marketwatch/{id}/items", data=data,
-                         headers=make_headers(csrf_token, auth_data))
+    resp = kite_session(csrf_token, auth_data).post(f"{KITE_API_URL}/marketwatch/{id}/items", data=data)
     if resp.ok:
         return True
     print(resp.text)
     return resp.ok
 
 
-def get_all_records(
-        worksheet,
-        empty2zero=False,
-        head=1,
-        default_blank="",
-        allow_underscores_in_numeric_literals=False,
-        numericise_ignore=None):
-    idx = head - 1
+def run_concurrently(fn, items, workers=http_client.POOL_SIZE, lane=None):
+    # returns (succeeded, failed) items, an exception counts as a failure; lane is the
+    # rate_limit priority the requests go out with
+    def call(item):
+        try:
+            if lane is not None:
+                with rate_limit.lane(lane):
+                    return fn(item)
+            return fn(item)
+        except Exception as e:
+            print(e)
+            return False
+
+    items = list(items)
+    if not items:
+        return [], []
+    succeeded, failed = [], []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for item, ok in zip(items, pool.map(call, items)):
+            (succeeded if ok else failed).append(item)
+    return succeeded, failed
+
+
+def sync_watchlist(watchlist, symbols, workers=http_client.POOL_SIZE):
+    current = {item.get('tradingsymbol'): item for item in watchlist.get('items', [])}
+    target = list(dict.fromkeys(symbols))
+    to_remove = [item for symbol, item in current.items() if symbol not in target]
+    to_add = [symbol for symbol in target if symbol not in current]
+
+    # removals first so additions do not run into the watchlist size limit
+    removed, remove_failed = run_concurrently(lambda item: remove_from_watchlist(watchlist, item), to_remove, workers,
+                                              rate_limit.LOW)
+    added, add_failed = run_concurrently(lambda symbol: add_to_watchlist(watchlist, symbol), to_add, workers,
+                                         rate_limit.LOW)
+    return {
+        'added': added,
+        'removed': [item.get('tradingsymbol') for item in removed],
+        'failed': add_failed + [item.get('tradingsymbol') for item in remove_failed],
+    }
+
 
-    data = worksheet.get_all_values(value_render_option='UNFORMATTED_VALUE')
-    worksheet.append_row()
-    if len(data) <= idx:
-        return []
+def find_watchlist(name):
+    resp = get_watchlists() or {}
+    for w in resp.get('data', []):
+        if w['name'] == name:
+            return w
+    return None
 
-    keys = data[idx]
 
-    if numericise_ignore == ['all']:
-        values = data[idx + 1:]
+def build_idea(symbol, entry, sl=0, ex=0, mloss=0, type='Long'):
+    symbol = (symbol or '').strip().upper()
+    if not symbol:
+        raise ValueError("Symbol not specified")
+    symbol, e1 = instruments.validate(symbol, str(entry).split('-')[0])
+    _, e2 = instruments.validate(symbol, str(entry).split('-')[-1])
+
+    if sl and float(sl) > e1:
+        type = 'Short'
+    elif sl and float(sl) < e1:
+        type = 'Long'
+    max_loss = float(mloss or 0)
+    if max_loss <= 0:
+        pos_size = None
     else:
-        values = [
-            numericise_all(
-                row,
-                empty2zero,
-                default_blank,
-                allow_underscores_in_numeric_literals,
-                numericise_ignore,
-            )
-            for row in data[idx + 1:]
-        ]
+        loss_per_share = abs(e1 - float(sl))
+        pos_size = math.floor(max_loss/loss_per_share)
+    return {'symbol': symbol, 'type': type, 'e1': e1, 'e2': e2, 'ex': ex, 'sl': sl, 'pos_size': pos_size}
+
+
+def next_business_day():
+    t = datetime.today()
+    return t + timedelta(days=((7 - t.weekday()) if t.weekday() > 4 else 0))
+
+
+def sheet_sink(ideas, cache=None):
+    # one range write for all ideas; returns symbol -> sheet row
+    if cache is None:
+        client, _, _ = google_sheet.init_google_sheet()
+        cache = sheet_cache.SheetCache(client)
+    nbd = next_business_day()
+    with google_sheet.BatchedWorksheet(cache.worksheet('Trade Log', 'Ideas'),
+                                       on_flush=lambda: cache.invalidate('Trade Log', 'Ideas')) as trade_sheet:
+        row = trade_sheet.append_rows([
+            [nbd.date().isoformat(), None, i['symbol'], i['type'], i['e1'], i['ex'], i['sl']] for i in ideas
+        ])
+    return {n: row + n for n in range(len(ideas))}
+
+
+def watch_sink(ideas, name, clear=False, workers=http_client.POOL_SIZE):
+    # one get_watchlists, then only the symbols not already on it are added; returns idea index -> added
+    w = find_watchlist(name)
+    if not w:
+        raise Exception(f"Watchlist {name} not found")
+    if clear:
+        if not empty_watchlist(w, workers=workers):
+            raise Exception(f"Clearing watchlist {name} was not successful")
+        w = dict(w, items=[])
+    present = {item.get('tradingsymbol') for item in w.get('items', [])}
+    missing = [i['symbol'] for i in ideas if i['symbol'] not in present]
+    added, _ = run_concurrently(lambda symbol: add_to_watchlist(w, symbol), missing, workers, rate_limit.LOW)
+    added = set(added)
+    return {n: i['symbol'] in present or i['symbol'] in added for n, i in enumerate(ideas)}
+
+
+def create_alert(idea):
+    import sentinal
+    return sentinal.with_retry(functools.partial(sentinal.create_advanced_trigger, idea['symbol'],
+                                                 (idea['e1'], idea['e2']), type=idea['type'],
+                                                 stoploss=idea['sl'], position_size=idea['pos_size']),
+                               idea['symbol'])['rule_name']
+
+
+def alert_sink(ideas, clear=False, clear_all=False, workers=http_client.POOL_SIZE):
+    # returns idea index -> rule name, None where the alert could not be created
+    import sentinal
+    if clear or clear_all:
+        sentinal.clear_triggers(all=clear_all)
+
+    def create(idea):
+        # alerts go ahead of watchlist updates when the endpoints are busy
+        try:
+            with rate_limit.lane(rate_limit.HIGH):
+                return create_alert(idea)
+        except Exception as e:
+            print(e)
+            return None
 
-    return [dict(zip(keys, row)) for row in values]
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(ideas)))) as pool:
+        return dict(enumerate(pool.map(create, ideas)))
+
+
+def idea_sinks(ideas, args, cache=None):
+    sinks = {}
+    if not args['no_sheet']:
+        sinks['sheet'] = lambda: sheet_sink(ideas, cache)
+    if not args['no_watch']:
+        sinks['watch'] = lambda: watch_sink(ideas, watchlist_name(args), args['clear'], args['workers'])
+    if not args['no_alert']:
+        sinks['alert'] = lambda: alert_sink(ideas, args['clear_triggers'], args['clear_triggers_all'],
+                                            args['workers'])
+    return sinks
+
+
+def run_sink(fn):
+    start = time.perf_counter()
+    try:
+        result = fn()
+        return {'ok': all(result.values()), 'result': result, 'seconds': time.perf_counter() - start}
+    except Exception as e:
+        return {'ok': False, 'error': str(e), 'seconds': time.perf_counter() - start}
+
+
+def run_sinks(sinks, concurrent=True):
+    # every sink has its own error handling, one failing does not stop the others
+    if not concurrent or len(sinks) < 2:
+        return {name: run_sink(fn) for name, fn in sinks.items()}
+    with ThreadPoolExecutor(max_workers=len(sinks)) as pool:
+        futures = {name: pool.submit(run_sink, fn) for name, fn in sinks.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def print_sink_report(results, ideas):
+    # sink results are keyed by the idea's index, a batch may hold two ideas on one symbol
+    print("--------------------------------------------")
+    for name, result in results.items():
+        if result['ok']:
+            status = 'ok'
+        elif 'error' in result:
+            status = f"failed: {result['error']}"
+        else:
+            status = f"failed for {', '.join(ideas[n]['symbol'] for n, v in result['result'].items() if not v)}"
+        print(f"{name:<8}{result['seconds']:>8.2f}s  {status}")
+    print("============================================")
+
+
+def read_ideas(path):
+    # csv with symbol and entry (e.g. 100-101) columns and optional sl, ex, mloss and type; - reads stdin
+    file = sys.stdin if path == '-' else open(path)
+    try:
+        rows = list(csv.DictReader(file))
+    finally:
+        if file is not sys.stdin:
+            file.close()
+    ideas, errors = [], []
+    for row in rows:
+        try:
+            ideas.append(build_idea(row['symbol'], row['entry'], row.get('sl') or 0, row.get('ex') or 0,
+                                    row.get('mloss') or 0, row.get('type') or 'Long'))
+        except Exception as e:
+            errors.append((row.get('symbol'), str(e)))
+    return ideas, errors
+
+
+def print_idea_table(ideas, results):
+    columns = [name for name in ('sheet', 'watch', 'alert') if name in results]
+    print(f"{'Symbol':<14}{'Type':<7}{'Entry':<20}{'SL':<10}{'Size':<8}" + ''.join(f"{c:<10}" for c in columns))
+    for n, i in enumerate(ideas):
+        cells = []
+        for c in columns:
+            value = results[c].get('result', {}).get(n) if results[c].get('result') else None
+            cells.append(f"{str(value if value not in (None, False) else 'FAILED'):<10}")
+        print(f"{i['symbol']:<14}{i['type']:<7}{str(i['e1']) + ' - ' + str(i['e2']):<20}{str(i['sl']):<10}"
+              f"{str(i['pos_size']):<8}" + ''.join(cells))
 
 
 def init_parser():
@@ -216,6 +368,12 @@ def init_parser():
     parser.add_argument('--swing', help="If this is to be added in swing watchlist", action='store_true')
     parser.add_argument('--long-term', help="If this is to be added to Long term Ideas", action='store_true')
     parser.add_argument('--waitlist', help="if this is to be added in waitlist", action='store_true')
+    parser.add_argument('--sync', help="Make the watchlist match the symbols in this file (e.g. ../data/NiftyBank.txt)")
+    parser.add_argument('--workers', help="Concurrent watchlist calls", type=int, default=http_client.POOL_SIZE)
+    parser.add_argument('--batch', help="Csv of ideas (symbol,entry,sl,ex,mloss,type) to add in one go, - for stdin")
+    parser.add_argument(startup.FLAG, help="Report import time per module", action='store_true')
+    parser.add_argument('--sequential', help="Run the sheet, watchlist and alert sinks one after another",
+                        action='store_true')
     parser.add_argument('-s', help="Symbol to add (NSE)")
     parser.add_argument('-type', help='Position type', default='Long')
     parser.add_argument('-e', help='Entry')
@@ -242,89 +400,44 @@ def watchlist_name(args):
 if __name__ == '__main__':
     parser = init_parser()
     args = vars(parser.parse_args())
+    if args['sync']:
+        name = watchlist_name(args)
+        w = find_watchlist(name)
+        if not w:
+            raise Exception(f"Watchlist {name} not found")
+        symbols, unknown = instruments.resolve_symbols(universe.load_symbols(args['sync']))
+        for symbol in unknown:
+            print(f"\tUnknown symbol {symbol}")
+        result = sync_watchlist(w, symbols, workers=args['workers'])
+        print(f"Watchlist {name}: added {len(result['added'])}, removed {len(result['removed'])}")
+        for symbol in result['failed']:
+            print(f"\tFailed {symbol}")
+        raise SystemExit(0)
+
+    if args['batch']:
+        ideas, errors = read_ideas(args['batch'])
+        for symbol, error in errors:
+            print(f"Skipping {symbol}: {error}")
+        results = run_sinks(idea_sinks(ideas, args), concurrent=not args['sequential'])
+        print_sink_report(results, ideas)
+        print_idea_table(ideas, results)
+        raise SystemExit(0)
+
     if not args['s']:
         raise Exception("Symbol not specified")
 
-    args['s'] = args['s'].upper()
-
-    e1 = float(args['e'].split('-')[0])
-    e2 = float(args['e'].split('-')[1])
-
-    if args['sl'] and float(args['sl']) > e1:
-        args['type'] = 'Short'
-    elif args['sl'] and float(args['sl']) < e1:
-        args['type'] = 'Long'
-    max_loss = float(args['mloss'])
-    if max_loss <= 0:
-        pos_size = None
-    else:
-        loss_per_share = abs(e1 - float(args['sl']))
-        pos_size = math.floor(max_loss/loss_per_share)
-
-    if not args['no_sheet']:
-        print("Syncing to google sheet")
-        print("--------------------------------------------")
-        client, _, _ = google_sheet.init_google_sheet()
-        spread_sheet = client.open('Trade Log')
-        trade_sheet = spread_sheet.worksheet('Ideas')
-        row_num = google_sheet.first_empty_row_based_on_col(trade_sheet, 2)
-        t = datetime.today()
-        nbd = t + timedelta(days=((7 - t.weekday()) if t.weekday() > 4 else 0))  # to calculate the next business day
-        trade_sheet.update(f'B{row_num}', [
-            [nbd.date().isoformat(), None, args['s'], args['type'], e1, args['ex'], args['sl']]
-        ], raw=False)
-        print("Syncing to google sheet done")
-        print("============================================")
-
-    if not args['no_watch']:
-        print("Adding to watchlist")
-        print("--------------------------------------------")
-        resp = get_watchlists()
-        watchlists = resp.get('data')
-        for w in watchlists:
-            if w['name'] == watchlist_name(args):
-                # this is the watch list we have to delete and add to
-                print(f"Found watchlist {w['name']}")
-                if args['clear']:
-                    print(f"Clearing Watchlist {w['name']}")
-                    status = empty_watchlist(w)
-                    if status:
-                        print(f"Watchlist {w['name']} is now empty")
-                    else:
-                        print(f"Watchlist {w['name']} is not successful")
-
-                print(f"Adding to watchlist {w['name']}")
-                status = add_to_watchlist(w, args['s'])
-                if status:
-                    print(f"{args['s']} added successfully")
-                else:
-                    print(f"{args['s']} cannot be added")
-        print("============================================")
+    idea = build_idea(args['s'], args['e'], args['sl'], args['ex'], args['mloss'], args['type'])
+    results = run_sinks(idea_sinks([idea], args), concurrent=not args['sequential'])
+    print_sink_report(results, [idea])
 
     rule_name = 'NA'
-    if not args['no_alert']:
-        import sentinal
-        all_clear = args['clear_triggers_all']
-        if args['clear_triggers'] or all_clear:
-            print(f'Clearing Triggers {all_clear}')
-            sentinal.clear_triggers(all=all_clear)
-        print("Creating sentinel alert")
-        print("--------------------------------------------")
-        try:
-            resp = sentinal.create_advanced_trigger(args['s'], (e1, e2), type=args['type'],
-                                                    stoploss=args['sl'], position_size=pos_size)
-            print(f"Sentinel alert created {resp['rule_name']}")
-            rule_name = resp['rule_name']
-        except Exception as e:
-            print("Error creating EQUAL alert")
-
-        print("============================================")
+    if results.get('alert') and results['alert']['ok']:
+        rule_name = results['alert']['result'][0]
 
     print("***********************************************")
-    print(f"Symbol\t\t\t{args['s']}")
-    print(f"Position size\t\t{pos_size}")
-    print(f"Entry Price\t\t{e1} - {e2}")
-    print(f"Stop Loss\t\t{args['sl']}")
+    print(f"Symbol\t\t\t{idea['symbol']}")
+    print(f"Position size\t\t{idea['pos_size']}")
+    print(f"Entry Price\t\t{idea['e1']} - {idea['e2']}")
+    print(f"Stop Loss\t\t{idea['sl']}")
     print(f"Rule name\t\t{rule_name}")
     print("***********************************************")
-
@@ -0,0 +1,68 @@
+import argparse
+import http.server
+import time
+
+# Mimics the Kite login: user id and password, then the PIN on the same page, then a redirect
+# that sets the session cookie. Run it and point KITE_LOGIN_URL or SENTINEL_LOGIN_URL at it.
+PAGE = """<!doctype html>
+<html><body>
+<form id="login">
+  <input id="userid"><input id="password" type="password">
+  <button type="submit">Login</button>
+</form>
+<form id="twofa" style="display:none">
+  <input id="pin" type="password">
+  <button type="submit">Continue</button>
+</form>
+<script>
+  document.getElementById('login').onsubmit = function (e) {
+    e.preventDefault();
+    setTimeout(function () {
+      document.getElementById('login').style.display = 'none';
+      document.getElementById('twofa').style.display = 'block';
+    }, DELAY);
+  };
+  document.getElementById('twofa').onsubmit = function (e) {
+    e.preventDefault();
+    window.location = '/done';
+  };
+</script>
+</body></html>
+"""
+
+
+def handler(cookie, delay):
+    class LoginHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/done':
+                time.sleep(delay / 1000)
+                self.send_response(302)
+                self.send_header('Set-Cookie', f"{cookie}=standin{int(time.time())}; Path=/; Max-Age=3600")
+                self.send_header('Location', '/dashboard')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.end_headers()
+            if self.path == '/dashboard':
+                self.wfile.write(b"<html><body>Logged in</body></html>")
+            else:
+                self.wfile.write(PAGE.replace('DELAY', str(delay)).encode())
+
+    return LoginHandler
+
+
+def init_parser():
+    parser = argparse.ArgumentParser(description='Serve a stand-in Kite login page for trying the browser login.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cookie', help="Session cookie set after the PIN, sentinel_csrftoken for Sentinel",
+                        default='public_token')
+    parser.add_argument('--delay', help="Milliseconds each step takes to respond", type=int, default=200)
+    return parser
+
+
+if __name__ == '__main__':
+    args = vars(init_parser().parse_args())
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', args['port']), handler(args['cookie'], args['delay']))
+    print(f"Stand-in login page on http://127.0.0.1:{args['port']}/")
+    server.serve_forever()
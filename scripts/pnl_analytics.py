@@ -0,0 +1,152 @@
+import argparse
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+
+STORE_DIR = os.getenv('PNL_STORE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.cache', 'pnl'))
+BUCKET_MINUTES = 30
+DIMENSIONS = {
+    'day': 'date',
+    'symbol': 'symbol',
+    'side': 'pos_type',
+    'time': 'time_bucket',
+}
+# rollups only hold additive sums, so new positions are merged without a rescan
+SUM_COLUMNS = ['trades', 'wins', 'losses', 'pnl', 'gross_win', 'gross_loss']
+SUM_TYPES = {'trades': np.int64, 'wins': np.int64, 'losses': np.int64,
+             'pnl': float, 'gross_win': float, 'gross_loss': float}
+
+
+def position_key(pos):
+    return pos['symbol'].astype(str) + '|' + pos['date'].astype(str) + '|' + \
+        pos['in_time'].astype(str) + '|' + pos['out_time'].astype(str)
+
+
+def enrich(pos):
+    # adds realized pnl and the time-of-day bucket of the entry
+    pnl = pos['sell_qty'] * pos['sell_price'] - pos['buy_qty'] * pos['buy_price']
+    entry = pd.to_datetime(pos['in_time'].astype(str), format='%H:%M:%S', errors='coerce')
+    minutes = (entry.dt.hour * 60 + entry.dt.minute) // BUCKET_MINUTES * BUCKET_MINUTES
+    bucket = (minutes // 60).astype('Int64').astype(str).str.zfill(2) + ':' + \
+        (minutes % 60).astype('Int64').astype(str).str.zfill(2)
+    return pos.assign(key=position_key(pos), pnl=pnl.round(4), time_bucket=bucket.fillna(''))
+
+
+def month_path(store_dir, month):
+    # positions are kept in one parquet file per entry month
+    return os.path.join(store_dir, 'positions', f"{month}.parquet")
+
+
+def write_parquet(frame, path):
+    tmp_path = f"{path}.tmp"
+    frame.reset_index(drop=True).to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def merge_month(store_dir, month, pos):
+    # adds the positions not already in the month's file; returns the ones added
+    path = month_path(store_dir, month)
+    if os.path.exists(path):
+        stored = pd.read_parquet(path)
+        pos = pos[~pos['key'].isin(stored['key'])]
+        if pos.empty:
+            return pos
+        write_parquet(pd.concat([stored, pos], ignore_index=True), path)
+    else:
+        write_parquet(pos, path)
+    return pos
+
+
+def compact_parts(store_dir):
+    # folds the numbered parts written by earlier versions into the monthly files, once
+    parts = sorted(glob.glob(os.path.join(store_dir, 'positions', 'part-*.parquet')))
+    if not parts:
+        return
+    pos = pd.concat([pd.read_parquet(p) for p in parts], ignore_index=True).drop_duplicates('key')
+    for month, group in pos.groupby(pos['date'].astype(str).str[:7]):
+        merge_month(store_dir, month, group)
+    for part in parts:
+        os.remove(part)
+
+
+def rollup(pos, column):
+    won = pos['pnl'] > 0
+    lost = pos['pnl'] < 0
+    return pd.DataFrame({
+        column: pos[column],
+        'trades': 1,
+        'wins': won.astype(np.int64),
+        'losses': lost.astype(np.int64),
+        'pnl': pos['pnl'],
+        'gross_win': pos['pnl'].where(won, 0.0),
+        'gross_loss': pos['pnl'].where(lost, 0.0),
+    }).groupby(column)[SUM_COLUMNS].sum()
+
+
+def rollup_path(store_dir, dimension):
+    return os.path.join(store_dir, f"rollup_{dimension}.parquet")
+
+
+def load_rollup(store_dir, dimension):
+    path = rollup_path(store_dir, dimension)
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=SUM_COLUMNS)
+    return pd.read_parquet(path)
+
+
+def add_positions(pos, store_dir=STORE_DIR):
+    # Adds unseen closed positions to their months' files and folds them into the rollups.
+    # Only the files of the months the positions were entered in are read, so an update
+    # costs the size of those months, not of the whole history.
+    pos = enrich(pos).drop_duplicates('key')
+    if pos.empty:
+        return 0
+    os.makedirs(os.path.join(store_dir, 'positions'), exist_ok=True)
+    compact_parts(store_dir)
+    added = [merge_month(store_dir, month, group)
+             for month, group in pos.groupby(pos['date'].astype(str).str[:7])]
+    pos = pd.concat(added, ignore_index=True)
+    if pos.empty:
+        return 0
+
+    for dimension, column in DIMENSIONS.items():
+        current = load_rollup(store_dir, dimension)
+        merged = current.add(rollup(pos, column), fill_value=0).astype(SUM_TYPES)
+        merged.index.name = column
+        merged.to_parquet(rollup_path(store_dir, dimension))
+    return len(pos)
+
+
+def summary(rollup_frame):
+    trades = rollup_frame['trades'].replace(0, np.nan)
+    avg_win = rollup_frame['gross_win'] / rollup_frame['wins'].replace(0, np.nan)
+    avg_loss = rollup_frame['gross_loss'] / rollup_frame['losses'].replace(0, np.nan)
+    return rollup_frame.assign(
+        win_rate=(rollup_frame['wins'] / trades).round(4),
+        avg_win=avg_win.round(2),
+        avg_loss=avg_loss.round(2),
+        expectancy=(rollup_frame['pnl'] / trades).round(2),
+    )
+
+
+def query(dimension, store_dir=STORE_DIR):
+    return summary(load_rollup(store_dir, dimension))
+
+
+def init_parser():
+    parser = argparse.ArgumentParser(description='Realized P&L rollups built from trade_log positions.')
+    parser.add_argument('--store', help="Analytics store directory", default=STORE_DIR)
+    parser.add_argument('--add', nargs='+', help="Closed position csv files written by trade_log.py --out")
+    parser.add_argument('--by', help="Rollup to show", choices=list(DIMENSIONS), default='symbol')
+    return parser
+
+
+if __name__ == '__main__':
+    args = vars(init_parser().parse_args())
+    for path in args['add'] or []:
+        added = add_positions(pd.read_csv(path, dtype={'date': str, 'in_time': str, 'out_time': str}),
+                              args['store'])
+        print(f"{path}: added {added} positions")
+    print(query(args['by'], args['store']).to_string())
@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+import re
+
+import sentinal
+from utils import http_client
+
+STATE_FILE = os.getenv('TRIGGER_STATE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'auth_data',
+                                                           'trigger_state.json'))
+# names produced by sentinal.trigger_name, e.g. INFY-gte-1500; only used by --adopt
+BASIC_TRIGGER_NAME = re.compile(r'^[A-Z0-9&_]+-(gt|gte|lt|lte|eq|noop)-.+$')
+
+
+def load_state(path=STATE_FILE):
+    try:
+        with open(path) as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        state = {}
+    return {'desired': state.get('desired', []), 'managed': state.get('managed', [])}
+
+
+def save_state(state, path=STATE_FILE):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(state, file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def desired_triggers(ideas):
+    desired = {}
+    for idea in ideas:
+        symbol, price, op = sentinal.idea_to_trigger(idea)
+        desired[sentinal.validated_name(symbol, price, op)] = (symbol, price, op)
+    return desired
+
+
+def is_managed(name, state):
+    # only triggers this script created (or adopted) are ever deleted, not ones made by hand,
+    # by daemon.py or by sentinal.py with the same naming scheme
+    return name in state['managed']
+
+
+def adopt(live_triggers, state):
+    # takes over existing basic triggers so the next plan may delete them
+    names = {t.get('rule_name') for t in live_triggers if BASIC_TRIGGER_NAME.match(t.get('rule_name') or '')}
+    return dict(state, managed=sorted(set(state['managed']) | names))
+
+
+def plan(desired, live_triggers, state):
+    # a fired (inactive) trigger still counts as present so it is not re-armed
+    live = {t.get('rule_name'): t for t in live_triggers}
+    to_create = {name: trigger for name, trigger in desired.items() if name not in live}
+    to_delete = [t for name, t in live.items() if name not in desired and is_managed(name, state)]
+    return to_create, to_delete
+
+
+def reconcile(ideas, state_path=STATE_FILE, verify=False, dry_run=False, workers=http_client.POOL_SIZE,
+              adopt_existing=False):
+    state = load_state(state_path)
+    desired = desired_triggers(ideas)
+    result = {'created': [], 'deleted': [], 'failed': [], 'to_create': [], 'to_delete': []}
+    if not verify and not adopt_existing and sorted(desired) == sorted(state['desired']):
+        return result
+
+    live_triggers = sentinal.get_triggers() or []
+    if adopt_existing:
+        state = adopt(live_triggers, state)
+    to_create, to_delete = plan(desired, live_triggers, state)
+    result['to_create'] = sorted(to_create)
+    result['to_delete'] = [t.get('rule_name') for t in to_delete]
+    if dry_run:
+        return result
+
+    deleted, failed_delete = sentinal.bulk_delete_triggers(to_delete, workers=workers)
+    created, failed_create = sentinal.bulk_create_triggers(to_create.values(), workers=workers)
+    result['created'], result['deleted'] = created, deleted
+    result['failed'] = failed_delete + failed_create
+
+    managed = (set(state['managed']) | set(created)) - set(deleted)
+    # only remember the sheet as applied once every change went through
+    save_state({'desired': sorted(desired) if not result['failed'] else state['desired'],
+                'managed': sorted(managed)}, state_path)
+    return result
+
+
+def init_parser():
+    parser = argparse.ArgumentParser(description='Sync sentinel triggers with the Ideas sheet, applying only the changes.')
+    parser.add_argument('--verify', help="Compare against live triggers even if the sheet did not change",
+                        action='store_true')
+    parser.add_argument('--dry-run', help="Print the changes without applying them", action='store_true')
+    parser.add_argument('--adopt', help="Also manage existing basic triggers, deleting those not in the sheet",
+                        action='store_true')
+    parser.add_argument('--workers', help="Concurrent API calls", type=int, default=http_client.POOL_SIZE)
+    parser.add_argument('--state', help="State file path", default=STATE_FILE)
+    parser.add_argument('--no-cache', help="Re-download the Ideas sheet", action='store_true')
+    return parser
+
+
+if __name__ == '__main__':
+    args = vars(init_parser().parse_args())
+    ideas = sentinal.load_ideas(use_cache=not args['no_cache'])
+    print(f"Found {len(ideas)} ideas")
+    result = reconcile(ideas, state_path=args['state'], verify=args['verify'], dry_run=args['dry_run'],
+                       workers=args['workers'], adopt_existing=args['adopt'])
+    if not (result['to_create'] or result['to_delete']):
+        print("Triggers are up to date")
+    for name in result['to_create']:
+        print(f"+ {name}")
+    for name in result['to_delete']:
+        print(f"- {name}")
+    if not args['dry_run']:
+        print(f"Created {len(result['created'])}, deleted {len(result['deleted'])}, failed {len(result['failed'])}")
+        for name in result['failed']:
+            print(f"\t{name}")
@@ -0,0 +1,278 @@
+import argparse
+import csv
+import math
+import re
+from datetime import datetime
+
+TOKEN = re.compile(r"\s*(?:(\d+\.\d*|\.\d+|\d+)|('[^']*')|([A-Za-z_][A-Za-z0-9_]*)|(&&|\|\||>=|<=|==|!=|[-+*/()<>!,]))")
+# binding power of the binary operators, higher binds tighter
+BINARY = {
+    '||': 1, '&&': 2,
+    '==': 3, '!=': 3,
+    '<': 4, '<=': 4, '>': 4, '>=': 4,
+    '+': 5, '-': 5,
+    '*': 6, '/': 6,
+}
+
+
+class RuleSyntaxError(Exception):
+    pass
+
+
+def tokenize(rule):
+    tokens, pos = [], 0
+    rule = rule.rstrip()
+    while pos < len(rule):
+        match = TOKEN.match(rule, pos)
+        if not match:
+            raise RuleSyntaxError(f"Unexpected input at {pos}: {rule[pos:pos + 10]!r}")
+        number, string, name, op = match.groups()
+        if number is not None:
+            tokens.append(('num', float(number)))
+        elif string is not None:
+            tokens.append(('str', string[1:-1]))
+        elif name is not None:
+            tokens.append(('name', name))
+        else:
+            tokens.append(('op', op))
+        pos = match.end()
+    return tokens
+
+
+class Parser:
+    # Pratt parser producing a small tuple ast:
+    # ('num', v), ('str', s), ('call', name, args), ('neg', x), ('not', x), ('bin', op, a, b)
+    def __init__(self, rule):
+        self.tokens = tokenize(rule)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def expect(self, value):
+        kind, token = self.next()
+        if token != value:
+            raise RuleSyntaxError(f"Expected {value!r}, got {token!r}")
+
+    def parse(self):
+        node = self.expression(0)
+        if self.pos != len(self.tokens):
+            raise RuleSyntaxError(f"Unexpected {self.peek()[1]!r}")
+        return node
+
+    def expression(self, min_power):
+        left = self.unary()
+        while True:
+            kind, op = self.peek()
+            if kind != 'op' or op not in BINARY or BINARY[op] <= min_power:
+                return left
+            self.next()
+            left = ('bin', op, left, self.expression(BINARY[op]))
+
+    def unary(self):
+        kind, token = self.next()
+        if kind == 'num':
+            return ('num', token)
+        if kind == 'str':
+            return ('str', token)
+        if kind == 'name':
+            self.expect('(')
+            args = []
+            if self.peek()[1] != ')':
+                args.append(self.expression(0))
+                while self.peek()[1] == ',':
+                    self.next()
+                    args.append(self.expression(0))
+            self.expect(')')
+            return ('call', token, args)
+        if token == '-':
+            return ('neg', self.unary())
+        if token == '!':
+            return ('not', self.unary())
+        if token == '(':
+            node = self.expression(0)
+            self.expect(')')
+            return node
+        raise RuleSyntaxError(f"Unexpected {token!r}")
+
+
+def parse(rule):
+    return Parser(rule).parse()
+
+
+def instruments(node):
+    # every 'EXCHANGE:SYMBOL' the rule reads a price for
+    if node[0] == 'call':
+        found = {a[1] for a in node[2] if a[0] == 'str'}
+        for arg in node[2]:
+            found |= instruments(arg)
+        return found
+    if node[0] in ('neg', 'not'):
+        return instruments(node[1])
+    if node[0] == 'bin':
+        return instruments(node[2]) | instruments(node[3])
+    return set()
+
+
+OPERATORS = {
+    '+': lambda a, b: a + b,
+    '-': lambda a, b: a - b,
+    '*': lambda a, b: a * b,
+    '/': lambda a, b: a / b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+}
+
+
+class Context:
+    # what a rule can see while it is evaluated: latest prices per instrument and the tick time
+    FUNCTIONS = {
+        'Math_Min': min,
+        'Math_Max': max,
+        'Math_Abs': abs,
+        'Math_Floor': math.floor,
+        'Math_Ceil': math.ceil,
+    }
+
+    def __init__(self, time=None):
+        self.time = time or datetime.now()
+        self.prices = {}
+
+    def call(self, name, args):
+        if name == 'LastTradedPrice':
+            return self.prices[args[0]]
+        if name == 'YearDay':
+            return self.time.timetuple().tm_yday
+        if name == 'Hour':
+            return self.time.hour
+        if name == 'Minute':
+            return self.time.minute
+        if name in self.FUNCTIONS:
+            return self.FUNCTIONS[name](*args)
+        raise RuleSyntaxError(f"Unknown function {name}")
+
+    def both(self, a, b):
+        return bool(a) and bool(b)
+
+    def either(self, a, b):
+        return bool(a) or bool(b)
+
+    def negate(self, a):
+        return not a
+
+
+def compile_node(node):
+    # turns the ast into nested closures evaluated against a Context
+    kind = node[0]
+    if kind in ('num', 'str'):
+        value = node[1]
+        return lambda ctx: value
+    if kind == 'neg':
+        inner = compile_node(node[1])
+        return lambda ctx: -inner(ctx)
+    if kind == 'not':
+        inner = compile_node(node[1])
+        return lambda ctx: ctx.negate(inner(ctx))
+    if kind == 'call':
+        name, args = node[1], [compile_node(a) for a in node[2]]
+        return lambda ctx: ctx.call(name, [a(ctx) for a in args])
+    op, left, right = node[1], compile_node(node[2]), compile_node(node[3])
+    if op == '&&':
+        return lambda ctx: ctx.both(left(ctx), right(ctx))
+    if op == '||':
+        return lambda ctx: ctx.either(left(ctx), right(ctx))
+    fn = OPERATORS[op]
+    return lambda ctx: fn(left(ctx), right(ctx))
+
+
+class Rule:
+    def __init__(self, name, rule):
+        self.name = name
+        self.rule = rule
+        self.ast = parse(rule)
+        self.instruments = instruments(self.ast)
+        self.evaluate = compile_node(self.ast)
+
+
+class RuleBook:
+    # Compiled rules indexed by instrument, so a tick only evaluates the rules that read it.
+    # A rule fires once, on the tick where it turns true, like a Sentinel trigger.
+    def __init__(self, rules=()):
+        self.rules = {}
+        self.by_instrument = {}
+        self.prices = {}
+        self.fired = set()
+        for name, rule in rules:
+            self.add(name, rule)
+
+    def add(self, name, rule):
+        compiled = Rule(name, rule)
+        self.rules[name] = compiled
+        for instrument in compiled.instruments:
+            self.by_instrument.setdefault(instrument, []).append(compiled)
+        return compiled
+
+    def on_tick(self, instrument, price, time=None):
+        self.prices[instrument] = price
+        ctx = Context(time)
+        ctx.prices = self.prices
+        fired = []
+        for rule in self.by_instrument.get(instrument, ()):
+            if rule.name in self.fired:
+                continue
+            try:
+                if rule.evaluate(ctx):
+                    self.fired.add(rule.name)
+                    fired.append(rule.name)
+            except (KeyError, ZeroDivisionError):
+                # another instrument in the rule has not ticked yet
+                continue
+        return fired
+
+
+def normalize_instrument(symbol):
+    return symbol if ':' in symbol else f"NSE:{symbol}"
+
+
+def replay(book, ticks):
+    # ticks: iterable of (time, instrument, price); yields (time, rule_name) as rules fire
+    for time, instrument, price in ticks:
+        for name in book.on_tick(normalize_instrument(instrument), price, time):
+            yield time, name
+
+
+def read_ticks(path):
+    # csv with time, symbol and price columns, time as ISO 8601
+    with open(path) as file:
+        for row in csv.DictReader(file):
+            yield datetime.fromisoformat(row['time']), row['symbol'], float(row['price'])
+
+
+def read_rules(path):
+    # csv with name and rule columns
+    with open(path) as file:
+        return [(row['name'], row['rule']) for row in csv.DictReader(file)]
+
+
+def init_parser():
+    parser = argparse.ArgumentParser(description='Evaluate Sentinel style alert rules against a tick file.')
+    parser.add_argument('rules', help="Csv with name and rule columns")
+    parser.add_argument('ticks', help="Csv with time, symbol and price columns")
+    return parser
+
+
+if __name__ == '__main__':
+    args = vars(init_parser().parse_args())
+    book = RuleBook(read_rules(args['rules']))
+    print(f"Loaded {len(book.rules)} rules on {len(book.by_instrument)} instruments")
+    for time, name in replay(book, read_ticks(args['ticks'])):
+        print(f"{time.isoformat()}\t{name}")
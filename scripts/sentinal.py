@@ -1,43 +1,41 @@
-import asyncio
+from utils import startup
+startup.install()
+
+import argparse
 import functools
-import pickle
 import os
-from utils import google_sheet
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from utils import auth, browser_login, credential_store, google_sheet, http_client, instruments, metrics, sheet_cache
 import base64
 import json
 
-import requests
-from gspread.utils import numericise_all
-from pyppeteer import launch
-from requests.cookies import RequestsCookieJar
+requests_cookies = startup.lazy_module('requests.cookies')
+rate_limit = startup.lazy_module('utils.rate_limit')
+requests_exceptions = startup.lazy_module('requests.exceptions')
+urllib3_exceptions = startup.lazy_module('urllib3.exceptions')
 
 SENTINAL_URL = "https://sentinel.zerodha.com/api"
+# point at a local stand-in page to try the login flow
+SENTINEL_LOGIN_URL = os.getenv('SENTINEL_LOGIN_URL', f"{SENTINAL_URL}/user/login/kite")
+# holds the csrf token and decides when the stored login has expired
+SESSION_COOKIE = 'sentinel_csrftoken'
 ZERODHA_USERID = os.getenv('ZERODHA_USERID')
 ZERODHA_PASSWORD = os.getenv("ZERODHA_PASSWORD")
 ZERODHA_PIN = os.getenv("ZERODHA_PIN")
+RETRY_DELAY = 0.5
+ADVANCED_HEADERS = {"content-type": "application/json", 'Content-transfer-encoding': 'base64'}
 
 
-def pickle_data(data):
-    with open('../auth_data/auth_data.txt', 'wb') as file:
-        pickle.dump(data, file)
-
-
-def load_data():
-    # for reading also binary mode is important
-    try:
-        data = None
-        with open('../auth_data/auth_data.txt', 'rb') as file:
-            data = pickle.load(file)
-        return data
-    except:
-        return None
+store = credential_store.CredentialStore('sentinel', SESSION_COOKIE, legacy='auth_data.txt')
 
 
 def load_cookies(data):
     if not data:
         return None
 
-    jar = RequestsCookieJar()
+    jar = requests_cookies.RequestsCookieJar()
     if not isinstance(data, list):
         data = [data]
 
@@ -50,7 +48,7 @@ def load_cookies(data):
         value = c.pop('value', None)
         c = trim_cookie(c)
         jar.set(name, value, **c)
-        if name == 'sentinel_csrftoken':
+        if name == SESSION_COOKIE:
             csrf_token = value
     return jar, csrf_token
 
@@ -64,45 +62,28 @@ def trim_cookie(c):
 
 
 async def sentinel_login():
-    print("Login with Zerodha")
-    browser = await launch()
-    page = await browser.newPage()
-    await page.goto(f'{SENTINAL_URL}/user/login/kite')
-    await page.type("#userid", ZERODHA_USERID)
-    await page.type("#password", ZERODHA_PASSWORD)
-    await page.click("button[type='submit'")
-    await page.waitFor(5000)
-    await page.type("#pin", ZERODHA_PIN)
-    await page.click("button[type='submit'")
-    await page.waitForNavigation()
-    await page.waitFor(5000)
-    print("Getting auth data from cookies")
-    cookies = await page.cookies()
-    pickle_data(cookies)
-    await browser.close()
-
-
-def authenticate(f):
-    @functools.wraps(f)
-    def wrapper(*args, **kwargs):
-        def execute_fun():
-            auth_data = load_data()
-            if auth_data:
-                jar, csrf_token = load_cookies(auth_data)
-                resp = f(*args, auth_data=jar, csrf_token=csrf_token, **kwargs)
-                return resp
-            raise ZeroDivisionError
+    cookies = await browser_login.login('sentinel', SENTINEL_LOGIN_URL, SESSION_COOKIE, ZERODHA_USERID, ZERODHA_PASSWORD, ZERODHA_PIN)
+    store.save(cookies)
 
-        try:
-            return execute_fun()
-        except ZeroDivisionError:
-            asyncio.get_event_loop().run_until_complete(sentinel_login())
-            return execute_fun()
 
-    return wrapper
+credentials = auth.CredentialCache(store, sentinel_login, load_cookies)
+authenticate = auth.authenticator(credentials)
 
 
-def process_response(resp):
+def sentinel_session(csrf_token, cookie_jar):
+    return http_client.bind_auth(http_client.get_session('sentinel'), getattr(cookie_jar, 'auth_generation', None),
+                                 lambda: ({'x-csrftoken': csrf_token}, cookie_jar))
+
+
+class Rejected(Exception):
+    # a 4xx other than 403, retrying sends the same invalid request again
+    def __init__(self, resp):
+        super().__init__(f"{resp.status_code} {resp.text}")
+        self.resp = resp
+
+
+def process_response(resp, strict=False):
+    # strict raises Rejected for error responses instead of returning None
     if resp.ok:
         return resp.json()
     else:
@@ -111,34 +92,105 @@ def process_response(resp):
 
     if resp.status_code == 403:
         raise ZeroDivisionError
+    if resp.status_code in rate_limit.THROTTLE_CODES:
+        raise rate_limit.Throttled(resp)
+    if strict:
+        raise Rejected(resp)
 
 
 @authenticate
-def get_triggers(auth_data=None, **kwargs):
-    resp = requests.get(f"{SENTINAL_URL}/triggers/all", cookies=auth_data)
+def get_triggers(auth_data=None, csrf_token=None, **kwargs):
+    resp = sentinel_session(csrf_token, auth_data).get(f"{SENTINAL_URL}/triggers/all")
     return process_response(resp)
 
 
 @authenticate
 def delete_trigger(hash_id, auth_data=None, csrf_token=None, **kwargs):
-    resp = requests.delete(f"{SENTINAL_URL}/triggers/detail/{hash_id}", headers={'x-csrftoken': csrf_token},
-                           cookies=auth_data)
+    resp = sentinel_session(csrf_token, auth_data).delete(f"{SENTINAL_URL}/triggers/detail/{hash_id}")
     return resp.ok
 
 
-def clear_triggers(all=False, auth_data=None, **kwargs):
+def trigger_symbol_matches(trigger, symbol):
+    name = trigger.get('rule_name') or ''
+    if trigger.get('stockA') == symbol or name.startswith(f"{symbol}-") or name.startswith(f"EQ_{symbol}_"):
+        return True
+    try:
+        rule = str(base64.b64decode(trigger.get('rule_string') or ''), 'utf-8')
+    except Exception:
+        rule = ''
+    return f"'NSE:{symbol}'" in rule
+
+
+def trigger_created_at(trigger):
     try:
-        all_triggers = get_triggers()
-        for trigger in all_triggers:
-            if all or not trigger['is_active']:
-                try:
-                    delete_trigger(trigger['hash_id'])
-                except:
-                    pass
+        return datetime.fromisoformat(str(trigger.get('created_at')).replace('Z', '+00:00'))
+    except ValueError:
         return None
+
+
+def trigger_filter(all=False, prefix=None, symbol=None, older_than=None):
+    # older_than is a timedelta; triggers without a parsable created_at never match it
+    def matches(trigger):
+        if not all and trigger.get('is_active'):
+            return False
+        if prefix and not (trigger.get('rule_name') or '').startswith(prefix):
+            return False
+        if symbol and not trigger_symbol_matches(trigger, symbol):
+            return False
+        if older_than is not None:
+            created_at = trigger_created_at(trigger)
+            if created_at is None:
+                return False
+            now = datetime.now(created_at.tzinfo)
+            if now - created_at < older_than:
+                return False
+        return True
+
+    return matches
+
+
+def delete_or_error(trigger):
+    try:
+        return delete_trigger(trigger['hash_id'])
     except Exception as e:
-        raise e
-        pass
+        print(f"Error deleting {trigger.get('rule_name')}: {e}")
+        return False
+
+
+def bulk_delete_triggers(triggers, workers=http_client.POOL_SIZE):
+    deleted, failed = [], []
+    triggers = list(triggers)
+    if not triggers:
+        return deleted, failed
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for trigger, ok in zip(triggers, pool.map(delete_or_error, triggers)):
+            (deleted if ok else failed).append(trigger.get('rule_name'))
+    return deleted, failed
+
+
+def clear_triggers(all=False, prefix=None, symbol=None, older_than=None, dry_run=False,
+                   workers=http_client.POOL_SIZE, **kwargs):
+    matches = trigger_filter(all=all, prefix=prefix, symbol=symbol, older_than=older_than)
+    triggers = [t for t in get_triggers() or [] if matches(t)]
+    result = {'matched': [t.get('rule_name') for t in triggers], 'deleted': [], 'failed': []}
+    if dry_run or not triggers:
+        return result
+
+    deleted, failed = bulk_delete_triggers(triggers, workers=workers)
+    result['deleted'], result['failed'] = deleted, failed
+    return result
+
+
+def print_clear_result(result, dry_run=False):
+    if dry_run:
+        print(f"Would delete {len(result['matched'])} triggers")
+        for name in result['matched']:
+            print(f"\t{name}")
+        return
+    print(f"Deleted {len(result['deleted'])} triggers")
+    print(f"Failed to delete {len(result['failed'])} triggers")
+    for name in result['failed']:
+        print(f"\t{name}")
 
 
 def to_operator_name(op):
@@ -146,35 +198,44 @@ def to_operator_name(op):
     return ops.get(op, 'noop')
 
 
+def trigger_name(symbol, price, op):
+    return f"{symbol}-{to_operator_name(op)}-{price}"
+
+
+def price_text(price):
+    # 1500.0 -> '1500', 1500.05 -> '1500.05'
+    return f"{price:f}".rstrip('0').rstrip('.') if isinstance(price, float) else str(price)
+
+
+def validate_trigger(symbol, price, op):
+    # -> (tradingsymbol, tick rounded price, rule name); raises instruments.UnknownSymbol
+    symbol, price = instruments.validate(symbol, price)
+    return symbol, price, trigger_name(symbol, price_text(price), op)
+
+
+def create_trigger(symbol, price, op):
+    # validated before authenticate, so a typo never starts a browser login
+    tradingsymbol, constant, name = validate_trigger(symbol, price, op)
+    return post_trigger(name, tradingsymbol, constant, op)
+
+
 @authenticate
-def create_trigger(symbol, price, op, auth_data=None, csrf_token=None):
+def post_trigger(name, tradingsymbol, constant, op, auth_data=None, csrf_token=None):
     url = f"{SENTINAL_URL}/triggers/new/basic"
-    payload = {"rule_name": f"{symbol}-{to_operator_name(op)}-{price}",
-               "basket_id": None, "constant_value": round(float(price), 2), "attributeA": "LastTradedPrice",
-               "stockA": symbol, "exchangeA": "NSE", "stockB": None, "exchangeB": None, "attributeB": None,
+    payload = {"rule_name": name,
+               "basket_id": None, "constant_value": constant, "attributeA": "LastTradedPrice",
+               "stockA": tradingsymbol, "exchangeA": "NSE", "stockB": None, "exchangeB": None, "attributeB": None,
                "operator": op, "rule_constant_compare": True}
     # payload = json.dumps(payload)
-    resp = requests.post(url, data=payload, headers={'x-csrftoken': csrf_token}, cookies=auth_data)
-    return process_response(resp)
+    resp = sentinel_session(csrf_token, auth_data).post(url, data=payload)
+    return process_response(resp, strict=True)
 
 
-@authenticate
-def create_advanced_trigger(symbol, price, type="Long", stoploss=None, position_size=None, auth_data=None, csrf_token=None):
-    url = f"{SENTINAL_URL}/triggers/new/advanced"
+def create_advanced_trigger(symbol, price, type="Long", stoploss=None, position_size=None):
+    symbol, _ = instruments.validate(symbol)
     name = f"EQ_{symbol}_{type}_{price}_{stoploss or ''}_{position_size or ''}"
     rule = f"LastTradedPrice('NSE:{str(symbol)}') >= {str(price[0])} && LastTradedPrice('NSE:{str(symbol)}') <= {str(price[1])}"
-    rule_base64 = base64.b64encode(bytes(rule, 'utf-8'))
-    payload = {
-        "rule_name": name,
-        "rule_string": str(rule_base64, 'utf-8'),
-        "basket_id": None
-    }
-    payload = json.dumps(payload)
-    resp = requests.post(url, data=payload,
-                         headers={'x-csrftoken': csrf_token, "content-type": "application/json",
-                                  'Content-transfer-encoding': 'base64'},
-                         cookies=auth_data)
-    return process_response(resp)
+    return create_advanced_trigger_with_rule(rule, name=name)
 
 
 @authenticate
@@ -187,56 +248,131 @@ def create_advanced_trigger_with_rule(rule, name=None, auth_data=None, csrf_toke
         "basket_id": None
     }
     payload = json.dumps(payload)
-    resp = requests.post(url, data=payload,
-                         headers={'x-csrftoken': csrf_token, "content-type": "application/json",
-                                  'Content-transfer-encoding': 'base64'},
-                         cookies=auth_data)
-    return process_response(resp)
+    resp = sentinel_session(csrf_token, auth_data).post(url, data=payload, headers=ADVANCED_HEADERS)
+    return process_response(resp, strict=True)
 
 
-def get_all_records(
-        worksheet,
-        empty2zero=False,
-        head=1,
-        default_blank="",
-        allow_underscores_in_numeric_literals=False,
-        numericise_ignore=None):
-    idx = head - 1
+def not_sent(e):
+    # the connection was never made, so the server cannot have acted on the request
+    if isinstance(e, requests_exceptions.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0] if e.args else None, 'reason', None)
+    return isinstance(e, requests_exceptions.ConnectionError) and isinstance(reason, urllib3_exceptions.NewConnectionError)
 
-    data = worksheet.get_all_values(value_render_option='UNFORMATTED_VALUE')
-    worksheet.append_row()
-    if len(data) <= idx:
-        return []
 
-    keys = data[idx]
+def is_retryable(e):
+    # Creating a trigger is not idempotent: only a 429 or a request that never left is sent
+    # again. A 5xx or a dropped connection may have created it, and a 403 has already been
+    # through authenticate's one re-login.
+    if isinstance(e, rate_limit.Throttled):
+        return e.resp.status_code == 429
+    return not_sent(e)
 
-    if numericise_ignore == ['all']:
-        values = data[idx + 1:]
-    else:
-        values = [
-            numericise_all(
-                row,
-                empty2zero,
-                default_blank,
-                allow_underscores_in_numeric_literals,
-                numericise_ignore,
-            )
-            for row in data[idx + 1:]
-        ]
 
-    return [dict(zip(keys, row)) for row in values]
+def with_retry(create, name, retries=2):
+    for attempt in range(retries + 1):
+        try:
+            resp = create()
+        except Exception as e:
+            if attempt >= retries or not is_retryable(e):
+                metrics.inc('create_failures_total')
+                raise Exception(f"Could not create {name}: {e}")
+            metrics.inc('create_retries_total')
+            time.sleep(RETRY_DELAY * 2 ** attempt)
+            continue
+        if resp:
+            return resp
+        metrics.inc('create_failures_total')
+        raise Exception(f"Could not create {name}: empty response")
+
+
+def bulk_create(jobs, workers=http_client.POOL_SIZE, retries=2):
+    # jobs: iterable of (rule_name, create callable); returns (created, failed) rule names
+    created, failed = [], []
+    jobs = list(jobs)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(rate_limit.in_lane(rate_limit.HIGH, with_retry), create, name, retries)
+                   for name, create in jobs]
+        for (name, _), future in zip(jobs, futures):
+            try:
+                created.append(future.result().get('rule_name') or name)
+            except Exception as e:
+                print(e)
+                failed.append(name)
+    return created, failed
+
+
+def validated_name(symbol, price, op):
+    # the rule name the trigger is created with, the sheet's spelling if the symbol is unknown
+    try:
+        return validate_trigger(symbol, price, op)[2]
+    except instruments.UnknownSymbol:
+        return trigger_name(symbol, price, op)
+
 
+def bulk_create_triggers(triggers, workers=http_client.POOL_SIZE, retries=2):
+    # triggers: iterable of (symbol, price, op)
+    jobs = [(validated_name(symbol, price, op), functools.partial(create_trigger, symbol, price, op))
+            for symbol, price, op in triggers]
+    return bulk_create(jobs, workers, retries)
 
-if __name__ == '__main__':
+
+def bulk_create_rules(rules, workers=http_client.POOL_SIZE, retries=2):
+    # rules: iterable of (rule_name, rule_string) for create_advanced_trigger_with_rule
+    jobs = [(name, functools.partial(create_advanced_trigger_with_rule, rule, name=name)) for name, rule in rules]
+    return bulk_create(jobs, workers, retries)
+
+
+def load_ideas(use_cache=True):
     client, _, _ = google_sheet.init_google_sheet()
-    spread_sheet = client.open('Trade Log')
-    ideas_sheet = spread_sheet.worksheet('Ideas')
-    ideas = get_all_records(ideas_sheet, head=4, numericise_ignore=['all'])
-    ideas = list(filter(lambda x: x['Symbol'] not in ('', '-'), ideas))
+    cache = sheet_cache.SheetCache(client)
+    if not use_cache:
+        cache.invalidate('Trade Log', 'Ideas')
+    values = cache.get_values('Trade Log', 'Ideas')
+    print(f"Sheet cache {cache.stats}")
+    ideas = google_sheet.records_from_values(values, head=4, numericise_ignore=['all'])
+    return list(filter(lambda x: x['Symbol'] not in ('', '-'), ideas))
+
+
+def idea_to_trigger(idea):
+    op = '<=' if idea['Type'] == 'Short' else '>='
+    return idea['Symbol'], idea['Entry'], op
+
+
+def init_parser():
+    parser = argparse.ArgumentParser(description='Create sentinel triggers for the ideas in the Trade Log sheet.')
+    parser.add_argument('--workers', help="Concurrent trigger creations", type=int, default=http_client.POOL_SIZE)
+    parser.add_argument('--retries', help="Retries per trigger", type=int, default=2)
+    parser.add_argument('--clear', help="Clear inactive triggers first", action='store_true')
+    parser.add_argument('--clear-all', help="Clear active triggers too", action='store_true')
+    parser.add_argument('--clear-only', help="Only clear triggers, dont create from ideas", action='store_true')
+    parser.add_argument('--prefix', help="Only clear triggers whose rule name starts with this (e.g. EQ_)")
+    parser.add_argument('--symbol', help="Only clear triggers on this symbol")
+    parser.add_argument('--older-than', help="Only clear triggers older than these many days", type=float)
+    parser.add_argument('--dry-run', help="Report what would be cleared", action='store_true')
+    parser.add_argument('--no-cache', help="Re-download the Ideas sheet", action='store_true')
+    parser.add_argument(startup.FLAG, help="Report import time per module", action='store_true')
+    return parser
+
+
+if __name__ == '__main__':
+    args = vars(init_parser().parse_args())
+    if args['clear'] or args['clear_all'] or args['clear_only']:
+        older_than = timedelta(days=args['older_than']) if args['older_than'] is not None else None
+        result = clear_triggers(all=args['clear_all'], prefix=args['prefix'],
+                                symbol=args['symbol'] and args['symbol'].upper(), older_than=older_than,
+                                dry_run=args['dry_run'], workers=args['workers'])
+        print_clear_result(result, dry_run=args['dry_run'])
+        if args['clear_only'] or args['dry_run']:
+            raise SystemExit(0)
+
+    ideas = load_ideas(use_cache=not args['no_cache'])
     print(f"Found {len(ideas)} ideas")
-    for idea in ideas:
-        if idea['Symbol']:
-            op = '>='
-            if idea['Type'] == 'Short':
-                op = '<='
-            create_trigger(idea['Symbol'], idea['Entry'], op)
+    created, failed = bulk_create_triggers([idea_to_trigger(idea) for idea in ideas],
+                                           workers=args['workers'], retries=args['retries'])
+    print(f"Created {len(created)} triggers")
+    for name in created:
+        print(f"\t{name}")
+    print(f"Failed {len(failed)} triggers")
+    for name in failed:
+        print(f"\t{name}")
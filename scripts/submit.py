@@ -0,0 +1,56 @@
+import argparse
+import json
+import os
+import socket
+import sys
+
+SOCKET_PATH = os.getenv('SUBMIT_SOCKET', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.cache',
+                                                    'submit.sock'))
+
+
+def submit(request, path=SOCKET_PATH):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        return json.loads(sock.makefile().readline())
+
+
+def init_parser():
+    parser = argparse.ArgumentParser(description='Send an idea, trigger or trendline to the running daemon.py.')
+    parser.add_argument('--socket', help="Unix socket path", default=SOCKET_PATH)
+    kinds = parser.add_subparsers(dest='kind', required=True)
+
+    kinds.add_parser('ping')
+    kinds.add_parser('metrics', help="Latency and counter report of the daemon")
+
+    idea = kinds.add_parser('idea', help="Same switches as idea_sync_kite.py")
+    idea.add_argument('-s', required=True)
+    idea.add_argument('-e', required=True)
+    idea.add_argument('-sl', default=0)
+    idea.add_argument('-ex', default=0)
+    idea.add_argument('-mloss', default=0)
+    idea.add_argument('-type', default='Long')
+    for flag in ('--no-sheet', '--no-alert', '--no-watch', '--swing', '--long-term', '--waitlist', '--clear',
+                 '--clear-triggers', '--clear-triggers-all', '--sequential'):
+        idea.add_argument(flag, action='store_true')
+
+    trigger = kinds.add_parser('trigger')
+    trigger.add_argument('-s', dest='symbol', required=True)
+    trigger.add_argument('-p', dest='price', required=True)
+    trigger.add_argument('--op', default='>=')
+
+    trendline = kinds.add_parser('trendline')
+    trendline.add_argument('-s', dest='symbol', required=True)
+    trendline.add_argument('--coords', nargs=3, type=int, required=True)
+    trendline.add_argument('--start', nargs=3, type=int, required=True)
+    trendline.add_argument('--down', action='store_true')
+    return parser
+
+
+if __name__ == '__main__':
+    args = vars(init_parser().parse_args())
+    path = args.pop('socket')
+    response = submit(args, path)
+    print(json.dumps(response, indent=2, default=str))
+    sys.exit(0 if response.get('ok') else 1)
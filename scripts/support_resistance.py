@@ -0,0 +1,102 @@
+import argparse
+import csv
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from ema_bundle import load_candles
+from utils import universe
+
+
+def pivots(high, low):
+    # same fractal as notebooks/Support_and_resistance: a low below both neighbours, which are
+    # below their own outer neighbours (and the mirror image for highs), on every bar at once
+    high = np.asarray(high, dtype=float)
+    low = np.asarray(low, dtype=float)
+    support = np.zeros(len(low), dtype=bool)
+    resistance = np.zeros(len(high), dtype=bool)
+    if len(low) < 5:
+        return support, resistance
+    l0, l1, l2, l3, l4 = (low[i:len(low) - 4 + i] for i in range(5))
+    h0, h1, h2, h3, h4 = (high[i:len(high) - 4 + i] for i in range(5))
+    support[2:-2] = (l2 < l1) & (l2 < l3) & (l3 < l4) & (l1 < l0)
+    resistance[2:-2] = (h2 > h1) & (h2 > h3) & (h3 > h4) & (h1 > h0)
+    resistance &= ~support
+    return support, resistance
+
+
+def find_levels(bars):
+    # pivots closer than the mean bar range to an already accepted level are dropped
+    support, resistance = pivots(bars['high'], bars['low'])
+    min_distance = np.mean(bars['high'] - bars['low'])
+    prices = np.where(support, bars['low'], bars['high'])
+    levels = []
+    for i in np.flatnonzero(support | resistance):
+        price = float(prices[i])
+        if all(abs(price - level[2]) >= min_distance for level in levels):
+            levels.append((int(i), 'S' if support[i] else 'R', price))
+    return levels
+
+
+def scan_symbol(args):
+    symbol, history_dir = args
+    bars = load_candles(history_dir, symbol)
+    if bars is None or len(bars) < 5:
+        return symbol, None, []
+    return symbol, float(bars['close'].iloc[-1]), find_levels(bars)
+
+
+def scan(symbols, history_dir, workers=None):
+    # one process per core by default; each symbol is independent
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(scan_symbol, [(s, history_dir) for s in symbols], chunksize=8))
+
+
+def level_rule(symbol, kind, price, band):
+    name = f"SR_{symbol}_{kind}_{round(price, 2)}"
+    low, high = round(price * (1 - band), 2), round(price * (1 + band), 2)
+    rule = f"LastTradedPrice('NSE:{symbol}') >= {low} && LastTradedPrice('NSE:{symbol}') <= {high}"
+    return name, rule
+
+
+def to_frame(results, within=None):
+    rows = []
+    for symbol, close, levels in results:
+        for bar, kind, price in levels:
+            distance = (price - close) / close if close else np.nan
+            if within is None or abs(distance) <= within:
+                rows.append({'symbol': symbol, 'type': kind, 'level': round(price, 2), 'bar': bar,
+                             'close': close, 'distance': round(distance, 4)})
+    return pd.DataFrame(rows, columns=['symbol', 'type', 'level', 'bar', 'close', 'distance'])
+
+
+def init_parser():
+    parser = argparse.ArgumentParser(description='Find pivot support and resistance levels across a universe.')
+    parser.add_argument('universe', help="Universe file from data/, e.g. FnO or ../data/Nifty")
+    parser.add_argument('history_dir', help="Directory of SYMBOL.csv OHLC files")
+    parser.add_argument('--workers', help="Processes to use, defaults to the cpu count", type=int)
+    parser.add_argument('--within', help="Only keep levels within this fraction of the last close", type=float,
+                        default=0.05)
+    parser.add_argument('--band', help="Alert band around a level as a fraction of it", type=float, default=0.002)
+    parser.add_argument('--rules-out', help="Write name,rule csv for the levels")
+    parser.add_argument('--submit', help="Create the level alerts on sentinel", action='store_true')
+    return parser
+
+
+if __name__ == '__main__':
+    args = vars(init_parser().parse_args())
+    symbols = universe.load_symbols(args['universe'])
+    table = to_frame(scan(symbols, args['history_dir'], args['workers']), args['within'])
+    print(table.to_string(index=False))
+
+    rules = [level_rule(r.symbol, r.type, r.level, args['band']) for r in table.itertuples()]
+    if args['rules_out']:
+        with open(args['rules_out'], 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['name', 'rule'])
+            writer.writerows(rules)
+    if args['submit']:
+        import sentinal
+        created, failed = sentinal.bulk_create_rules(rules)
+        print(f"Created {len(created)} level alerts, failed {len(failed)}")
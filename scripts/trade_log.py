@@ -1,71 +1,295 @@
-import pandas as pd
-import copy
+from utils import startup
+startup.install()
+
+import argparse
+import glob
 import json
-from utils import google_sheet
-pos_size = {}
-current_position = {}
-positions = []
-
-
-def update_avg_prices_and_quantities(d):
-    cp = current_position[d['Instrument']]
-    qty = d['Qty.'].split('/')[1]
-    avg = d['Avg. price']
-    if d['Type'] == 'BUY':
-        prev_price = cp['buy_qty'] * cp['buy_price']
-        cp['buy_qty'] += int(qty)
-        cp['buy_price'] = (prev_price + int(qty) * float(avg))/cp['buy_qty']
-    else:
-        prev_price = cp['sell_qty'] * cp['sell_price']
-        cp['sell_qty'] += int(qty)
-        cp['sell_price'] = (prev_price + int(qty) * float(avg)) / cp['sell_qty']
+import os
+
+from utils import google_sheet, sheet_cache
+
+# pandas is only imported once there are orders to process
+np = startup.lazy_module('numpy')
+pd = startup.lazy_module('pandas')
+
+ORDER_COLUMNS = ['time', 'symbol', 'is_buy', 'qty', 'price', 'signed_qty']
+ORDER_TYPES = {'is_buy': bool, 'qty': 'int64', 'price': float, 'signed_qty': 'int64'}
+POSITION_COLUMNS = ['date', 'in_time', 'pos_type', 'symbol', 'buy_qty', 'buy_price',
+                    'out_time', 'sell_qty', 'sell_price']
+# order or trade id columns, used to tell orders apart when the export has one
+ID_COLUMNS = ('Trade ID', 'Order ID')
+
+
+def normalize_orders(data):
+    # one row per order with numeric quantity, price and signed quantity
+    orders = pd.DataFrame({
+        'time': data['Time'].astype(str),
+        'symbol': data['Instrument'],
+        'is_buy': data['Type'].eq('BUY'),
+        'qty': data['Qty.'].astype(str).str.split('/').str[1].astype(np.int64),
+        'price': data['Avg. price'].astype(float),
+    })
+    orders['signed_qty'] = np.where(orders['is_buy'], orders['qty'], -orders['qty'])
+    return orders
+
+
+def assign_segments(orders):
+    # A position runs from an order taken while flat until the cumulative signed quantity
+    # of that instrument returns to zero; each such run gets its own segment number.
+    orders = orders.sort_values(['symbol', 'time'], kind='mergesort').reset_index(drop=True)
+    net = orders.groupby('symbol', sort=False)['signed_qty'].cumsum()
+    was_flat = net.groupby(orders['symbol'], sort=False).shift(1, fill_value=0).eq(0)
+    return orders.assign(net_qty=net, segment=was_flat.cumsum())
+
+
+def open_orders(orders):
+    # orders of the positions still open at the end of the frame
+    orders = assign_segments(orders)
+    final_net = orders.groupby('segment')['net_qty'].transform('last')
+    return orders.loc[final_net.ne(0), ORDER_COLUMNS].reset_index(drop=True)
+
+
+def reconstruct_positions(orders):
+    # Returns (closed, open) position frames.
+    orders = assign_segments(orders)
+    net = orders['net_qty']
+    segment = orders['segment']
+
+    buy_qty = orders['qty'].where(orders['is_buy'], 0)
+    sell_qty = orders['qty'].where(~orders['is_buy'], 0)
+    legs = pd.DataFrame({
+        'segment': segment,
+        'symbol': orders['symbol'],
+        'first_time': orders['time'],
+        'last_time': orders['time'],
+        'opened_long': orders['is_buy'],
+        'buy_qty': buy_qty,
+        'buy_value': buy_qty * orders['price'],
+        'sell_qty': sell_qty,
+        'sell_value': sell_qty * orders['price'],
+        'net_qty': net,
+    })
+    grouped = legs.groupby('segment', sort=False).agg({
+        'symbol': 'first', 'first_time': 'first', 'last_time': 'last', 'opened_long': 'first',
+        'buy_qty': 'sum', 'buy_value': 'sum', 'sell_qty': 'sum', 'sell_value': 'sum', 'net_qty': 'last',
+    })
+
+    in_time = grouped['first_time'].str.split(' ', n=1, expand=True)
+    out_time = grouped['last_time'].str.split(' ', n=1, expand=True)
+    is_closed = grouped['net_qty'].eq(0)
+    positions = pd.DataFrame({
+        'date': in_time[0],
+        'in_time': in_time[1],
+        'pos_type': np.where(grouped['opened_long'], 'Long', 'Short'),
+        'symbol': grouped['symbol'],
+        'buy_qty': grouped['buy_qty'],
+        'buy_price': (grouped['buy_value'] / grouped['buy_qty'].replace(0, np.nan)).fillna(0),
+        'out_time': out_time[1].where(is_closed, ''),
+        'sell_qty': grouped['sell_qty'],
+        'sell_price': (grouped['sell_value'] / grouped['sell_qty'].replace(0, np.nan)).fillna(0),
+    }, columns=POSITION_COLUMNS)
+    closed = positions[is_closed].sort_values(['date', 'in_time'], kind='mergesort').reset_index(drop=True)
+    open_positions = positions[~is_closed].reset_index(drop=True)
+    return closed, open_positions
 
 
 def get_logs_from_csv(file_path):
-    data = pd.read_csv(file_path)
-    data = data.sort_values('Time', ascending=True)
-    for d in data.iloc:
-        if pos_size.get(d['Instrument'], 0) == 0:
-            pos_size[d['Instrument']] = 0
-
-        if pos_size[d['Instrument']] == 0:
-            # this is a first order
-            pos_type = 'Long' if d['Type'] == 'BUY' else 'Short'
-            new_pos = True
-            pos_size[d['Instrument']] = int(d['Qty.'].split('/')[1]) * (1 if d['Type'] == 'BUY' else -1)
-            current_position[d['Instrument']] = {
-                'date': d['Time'].split(' ')[0],
-                'in_time': d['Time'].split(' ')[1],
-                'pos_type': pos_type,
-                'symbol': d['Instrument'],
-                'buy_qty': 0,
-                'buy_price': 0,
-                'out_time': '',
-                'sell_qty': 0,
-                'sell_price': 0
-            }
-            update_avg_prices_and_quantities(d)
+    closed, _ = reconstruct_positions(normalize_orders(pd.read_csv(file_path)))
+    return closed
+
+
+def order_files(sources):
+    # sources are csv files, directories of csv files or glob patterns
+    files = []
+    for source in sources:
+        if os.path.isdir(source):
+            files.extend(glob.glob(os.path.join(source, '*.csv')))
+        elif any(c in source for c in '*?['):
+            files.extend(glob.glob(source))
         else:
-            pos_size[d['Instrument']] += int(d['Qty.'].split('/')[1]) * (1 if d['Type'] == 'BUY' else -1)
-            new_pos = False
-            update_avg_prices_and_quantities(d)
-            if pos_size[d['Instrument']] == 0:
-                current_position[d['Instrument']]['out_time'] = d['Time'].split(' ')[1]
-                positions.append(copy.deepcopy(current_position[d['Instrument']]))
-            current_position[d['Instrument']] = {}
+            files.append(source)
+    return sorted(dict.fromkeys(files))
+
+
+def load_checkpoint(path=None):
+    checkpoint = {}
+    if path:
+        try:
+            with open(path) as file:
+                checkpoint = json.load(file)
+        except (OSError, ValueError):
+            pass
+    files, last_time, boundary = {}, checkpoint.get('last_time', ''), checkpoint.get('boundary', {})
+    for path, entry in checkpoint.get('files', {}).items():
+        if isinstance(entry, dict):
+            # per-file key counts written by an earlier version; only the keys of the latest
+            # second are kept, as the boundary
+            for key, count in entry.get('seen', {}).items():
+                time = key.split('|', 1)[0]
+                if time > last_time:
+                    last_time, boundary = time, {}
+                if time == last_time:
+                    boundary[key] = max(boundary.get(key, 0), count)
+            entry = entry['signature']
+        files[path] = entry
+    return {'files': files, 'last_time': last_time, 'boundary': boundary,
+            'open_orders': checkpoint.get('open_orders', [])}
+
+
+def save_checkpoint(checkpoint, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(checkpoint, file, indent=2)
+    os.replace(tmp_path, path)
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return f"{stat.st_size}:{int(stat.st_mtime)}"
+
+
+def order_keys(data, orders):
+    # the export's own id when it has one, otherwise the order's content
+    for column in ID_COLUMNS:
+        if column in data:
+            return data[column].astype(str)
+    return (orders['time'] + '|' + orders['symbol'].astype(str) + '|' + orders['is_buy'].astype(str) + '|'
+            + orders['qty'].astype(str) + '|' + orders['price'].astype(str))
+
+
+def first_new_time(path, last_time='', chunksize=100000):
+    # earliest order time at or after the checkpoint, None if the file has nothing that late
+    first = None
+    for chunk in pd.read_csv(path, usecols=['Time'], chunksize=chunksize):
+        times = chunk['Time'].astype(str)
+        times = times[times >= last_time]
+        if len(times) and (first is None or times.min() < first):
+            first = times.min()
+    return first
+
+
+def read_new_orders(path, last_time='', boundary=None, chunksize=100000):
+    # Returns (new orders, latest time, key counts of the latest second). Orders after
+    # last_time are new; in the last_time second itself only the occurrences beyond the
+    # boundary counts are, so a re-export with one more fill in that second still adds it.
+    boundary = boundary or {}
+    at_boundary = {}
+    latest, latest_counts = '', {}
+    chunks = []
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        orders = normalize_orders(chunk)
+        keys = order_keys(chunk, orders)
+
+        same = orders['time'].eq(last_time)
+        new = orders['time'] > last_time
+        if same.any():
+            same_keys = keys[same]
+            occurrence = (same_keys.groupby(same_keys, sort=False).cumcount()
+                          + same_keys.map(at_boundary).fillna(0).astype(int))
+            new[same] = occurrence >= same_keys.map(boundary).fillna(0).astype(int)
+            for key, count in same_keys.value_counts().items():
+                at_boundary[key] = at_boundary.get(key, 0) + int(count)
+        if new.any():
+            chunks.append(orders[new])
+
+        chunk_latest = orders['time'].max()
+        if chunk_latest > latest:
+            latest, latest_counts = chunk_latest, {}
+        if chunk_latest == latest:
+            for key, count in keys[orders['time'].eq(latest)].value_counts().items():
+                latest_counts[key] = latest_counts.get(key, 0) + int(count)
+    if not chunks:
+        return pd.DataFrame(columns=ORDER_COLUMNS), latest, latest_counts
+    return pd.concat(chunks, ignore_index=True), latest, latest_counts
+
+
+def ingest(sources, checkpoint_path=None, chunksize=100000):
+    # Returns (changed files, closed positions or None if there were no new orders).
+    # Orders up to the checkpoint's high-watermark time are already done, whichever file they
+    # came from, so overlapping re-exports only add what is new. Changed files are replayed
+    # one at a time, oldest new order first, with the orders of positions still open.
+    checkpoint = load_checkpoint(checkpoint_path)
+    changed, pending = [], []
+    for path in order_files(sources):
+        signature = file_signature(path)
+        if checkpoint['files'].get(path) == signature:
+            continue
+        changed.append(path)
+        checkpoint['files'][path] = signature
+        first = first_new_time(path, checkpoint['last_time'], chunksize)
+        if first is not None:
+            pending.append((first, path))
+
+    closed = []
+    carry = None
+    for _, path in sorted(pending):
+        orders, latest, latest_counts = read_new_orders(path, checkpoint['last_time'], checkpoint['boundary'],
+                                                        chunksize)
+        if latest > checkpoint['last_time']:
+            checkpoint['last_time'], checkpoint['boundary'] = latest, latest_counts
+        elif latest == checkpoint['last_time']:
+            boundary = checkpoint['boundary']
+            for key, count in latest_counts.items():
+                boundary[key] = max(boundary.get(key, 0), count)
+        if not len(orders):
+            continue
+        if carry is None:
+            carry = pd.DataFrame(checkpoint['open_orders'], columns=ORDER_COLUMNS)
+        orders = pd.concat([carry, orders], ignore_index=True).astype(ORDER_TYPES)
+        file_closed, _ = reconstruct_positions(orders)
+        closed.append(file_closed)
+        carry = open_orders(orders)
+        checkpoint['open_orders'] = carry.to_dict('records')
+    if changed and checkpoint_path:
+        save_checkpoint(checkpoint, checkpoint_path)
+    if not closed:
+        return changed, None
+    return changed, pd.concat(closed, ignore_index=True)
+
+
+def init_parser():
+    parser = argparse.ArgumentParser(description='Build closed positions from broker tradebook exports.')
+    parser.add_argument('sources', nargs='*', default=['orders-2.csv'],
+                        help="Order csv files, directories or glob patterns")
+    parser.add_argument('--checkpoint', help="Checkpoint file, later runs only process new orders")
+    parser.add_argument('--chunksize', help="Rows read at a time", type=int, default=100000)
+    parser.add_argument('--out', help="Append closed positions to this csv")
+    parser.add_argument('--no-sheet', help="Dont sync to google sheet", action='store_true')
+    parser.add_argument('--store', help="Also add closed positions to this P&L analytics store")
+    parser.add_argument(startup.FLAG, help="Report import time per module", action='store_true')
+    return parser
+
+
+def write_positions(pos, out=None, trade_sheet=None):
+    if out:
+        pos.to_csv(out, mode='a', header=not os.path.exists(out), index=False)
+    else:
+        print(pos.to_csv())
+    if trade_sheet is not None:
+        trade_sheet.append_rows([
+            [d['date'], d['symbol'], 'Closed',
+             d['pos_type'], d['buy_qty'], d['buy_price'],
+             None, d['sell_price'], None, d['in_time'], d['out_time']] for d in pos.to_dict('records')
+        ])
 
 
 if __name__ == '__main__':
-    get_logs_from_csv("orders-2.csv")
-    pos = pd.read_json(json.dumps(positions))
-    print(pos.to_csv())
-    client, _, _ = google_sheet.init_google_sheet()
-
-    spread_sheet = client.open('Trade Log')
-    trade_sheet = spread_sheet.worksheet('DT Trades')
-    row_num = google_sheet.first_empty_row_based_on_col(trade_sheet, 2)
-    trade_sheet.update(f'B{row_num}', [
-        [d['date'], d['symbol'], 'Closed',
-         d['pos_type'], d['buy_qty'], d['buy_price'],
-         None, d['sell_price'], None, d['in_time'], d['out_time']] for d in positions
-    ], raw=False)
+    args = vars(init_parser().parse_args())
+    trade_sheet = None
+
+    changed, pos = ingest(args['sources'], args['checkpoint'], args['chunksize'])
+    for path in changed:
+        print(f"Read new orders from {path}")
+    if pos is not None and len(pos):
+        if not args['no_sheet']:
+            client, _, _ = google_sheet.init_google_sheet()
+            cache = sheet_cache.SheetCache(client)
+            trade_sheet = google_sheet.BatchedWorksheet(cache.worksheet('Trade Log', 'DT Trades'),
+                                                       on_flush=lambda: cache.invalidate('Trade Log', 'DT Trades'))
+        write_positions(pos, args['out'], trade_sheet)
+        if args['store']:
+            import pnl_analytics
+            pnl_analytics.add_positions(pos, args['store'])
+        if trade_sheet is not None:
+            trade_sheet.flush()
+    print(f"Found {0 if pos is None else len(pos)} closed positions")
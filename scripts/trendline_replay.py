@@ -0,0 +1,127 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+import rule_engine
+
+TIME_COLUMNS = ('datetime', 'date', 'time', 'timestamp')
+
+
+class ArrayContext(rule_engine.Context):
+    # evaluates a compiled rule for every bar at once: prices and clock functions are arrays
+    FUNCTIONS = {
+        'Math_Min': np.minimum,
+        'Math_Max': np.maximum,
+        'Math_Abs': np.abs,
+        'Math_Floor': np.floor,
+        'Math_Ceil': np.ceil,
+    }
+
+    def __init__(self, times, prices):
+        self.times = pd.DatetimeIndex(times)
+        self.prices = prices
+        self.year_day = self.times.dayofyear.to_numpy()
+        self.hour = self.times.hour.to_numpy()
+        self.minute = self.times.minute.to_numpy()
+
+    def call(self, name, args):
+        if name == 'YearDay':
+            return self.year_day
+        if name == 'Hour':
+            return self.hour
+        if name == 'Minute':
+            return self.minute
+        return super().call(name, args)
+
+    def both(self, a, b):
+        return np.logical_and(a, b)
+
+    def either(self, a, b):
+        return np.logical_or(a, b)
+
+    def negate(self, a):
+        return np.logical_not(a)
+
+
+def load_bars(history_dir, symbol):
+    path = os.path.join(history_dir, f"{symbol}.csv")
+    if not os.path.exists(path):
+        return None
+    bars = pd.read_csv(path)
+    bars.columns = [c.strip().lower() for c in bars.columns]
+    time_column = next(c for c in TIME_COLUMNS if c in bars.columns)
+    bars['time'] = pd.to_datetime(bars[time_column])
+    return bars.sort_values('time').reset_index(drop=True)
+
+
+def evaluate(rule, bars, price='hl'):
+    # True for every bar where the rule holds. With 'hl' a bar counts if the rule holds at
+    # its high or its low, which covers any price inside a bar for a trendline rule.
+    instrument = next(iter(rule.instruments))
+    columns = ('high', 'low') if price == 'hl' else (price,)
+    hits = np.zeros(len(bars), dtype=bool)
+    for column in columns:
+        ctx = ArrayContext(bars['time'], {instrument: bars[column].to_numpy(dtype=float)})
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hits |= np.broadcast_to(np.asarray(rule.evaluate(ctx), dtype=bool), hits.shape)
+    return hits
+
+
+def crossings(hits):
+    # bars where the rule turns true after being false on the previous bar
+    previous = np.concatenate(([False], hits[:-1]))
+    return np.flatnonzero(hits & ~previous)
+
+
+def replay(rules, history_dir, price='hl'):
+    # rules: iterable of (name, rule string); returns one row per crossing
+    by_symbol = {}
+    for name, rule in rules:
+        compiled = rule_engine.Rule(name, rule)
+        if len(compiled.instruments) != 1:
+            print(f"Skipping {name}: replay needs a rule on exactly one instrument")
+            continue
+        symbol = next(iter(compiled.instruments)).split(':')[-1]
+        by_symbol.setdefault(symbol, []).append(compiled)
+
+    rows = []
+    for symbol, compiled_rules in by_symbol.items():
+        bars = load_bars(history_dir, symbol)
+        if bars is None:
+            print(f"No history for {symbol}")
+            continue
+        for compiled in compiled_rules:
+            for i in crossings(evaluate(compiled, bars, price)):
+                rows.append({'name': compiled.name, 'symbol': symbol, 'bar': int(i), 'time': bars['time'][i],
+                             'open': bars['open'][i], 'high': bars['high'][i], 'low': bars['low'][i],
+                             'close': bars['close'][i]})
+    return pd.DataFrame(rows, columns=['name', 'symbol', 'bar', 'time', 'open', 'high', 'low', 'close'])
+
+
+def init_parser():
+    parser = argparse.ArgumentParser(description='Replay trendline alert rules over 1 minute OHLC history.')
+    parser.add_argument('history_dir', help="Directory of SYMBOL.csv 1 minute candles")
+    parser.add_argument('--trendlines', help="Trendline csv in the alert_trendline.py --batch format")
+    parser.add_argument('--rules', help="Csv with name and rule columns")
+    parser.add_argument('--price', help="Bar price the rule sees", choices=['hl', 'open', 'high', 'low', 'close'],
+                        default='hl')
+    parser.add_argument('--first', help="Only report the first crossing, when the alert would fire",
+                        action='store_true')
+    return parser
+
+
+if __name__ == '__main__':
+    args = vars(init_parser().parse_args())
+    rules = []
+    if args['trendlines']:
+        import alert_trendline
+        rules.extend(alert_trendline.read_trendlines(args['trendlines']))
+    if args['rules']:
+        rules.extend(rule_engine.read_rules(args['rules']))
+
+    result = replay(rules, args['history_dir'], args['price'])
+    if args['first']:
+        result = result.groupby('name', sort=False).head(1)
+    print(result.to_string(index=False))
@@ -0,0 +1,139 @@
+import asyncio
+import functools
+import threading
+import time
+
+from utils import metrics
+
+# refresh a little before the session cookie actually expires
+EXPIRY_SKEW = 60
+# credentials saved this recently are never stale, whatever their cookie says
+LOGIN_GRACE = 60
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+class Credentials:
+    def __init__(self, jar, csrf_token, expires_at=None, generation=0, saved_at=None):
+        self.jar = jar
+        self.csrf_token = csrf_token
+        self.expires_at = expires_at
+        self.generation = generation
+        self.saved_at = saved_at
+
+    def is_fresh(self, now=None):
+        return is_fresh(self.expires_at, self.saved_at, now)
+
+
+def is_fresh(expires_at, saved_at=None, now=None):
+    if expires_at is None:
+        return True
+    return (now or time.time()) < max(expires_at - EXPIRY_SKEW, (saved_at or 0) + LOGIN_GRACE)
+
+
+def cookie_expiry(cookies, name=None):
+    # expiry of the named session cookie; tracking cookies such as __cf_bm expire far sooner
+    # than the session and must not decide when to log in again
+    expiries = [c.get('expires') for c in cookies if isinstance(c, dict) and (name is None or c.get('name') == name)]
+    expiries = [e for e in expiries if isinstance(e, (int, float)) and e > 0]
+    return min(expiries) if expiries else None
+
+
+def login_loop():
+    # one event loop on a background thread for every login, so a resident browser stays usable
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='login-loop', daemon=True).start()
+        return _loop
+
+
+def run_login(login):
+    return asyncio.run_coroutine_threadsafe(login(), login_loop()).result()
+
+
+class CredentialCache:
+    def __init__(self, store, login, parse):
+        # store -> credential_store.CredentialStore, login() -> coroutine that saves fresh
+        # cookies to the store, parse(raw) -> (cookie_jar, csrf_token)
+        self._store = store
+        self._login = login
+        self._parse = parse
+        self._creds = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        creds = self._creds
+        if creds is not None and creds.is_fresh():
+            return creds
+        with self._lock:
+            creds = self._creds
+            if creds is not None and creds.is_fresh():
+                return creds
+            creds = self._read()
+            if creds is None or not creds.is_fresh():
+                creds = self._relogin(creds)
+            return creds
+
+    def refresh(self, stale=None):
+        # single flight: callers that saw the same stale credentials wait for one login
+        with self._lock:
+            current = self._creds
+            if current is not None and stale is not None and current.generation != stale.generation:
+                return current
+            return self._relogin(stale)
+
+    def invalidate(self):
+        with self._lock:
+            self._creds = None
+
+    def _read(self):
+        record = self._store.load()
+        if not record or not record.get('cookies'):
+            return None
+        parsed = self._parse([dict(c) for c in record['cookies']])
+        if not parsed:
+            return None
+        jar, csrf_token = parsed
+        self._generation += 1
+        # sessions bind to the jar by generation, see http_client.bind_auth
+        jar.auth_generation = self._generation
+        self._creds = Credentials(jar, csrf_token, record.get('expires_at'), self._generation,
+                                  record.get('saved_at'))
+        return self._creds
+
+    def _relogin(self, stale=None):
+        # other processes share the store; if one of them logged in while we waited for the
+        # lease its cookies are used instead of opening another browser
+        self._creds = None
+        start = time.perf_counter()
+        if self._store.login(lambda: run_login(self._login), stale.saved_at if stale else None):
+            metrics.inc('relogins_total', service=self._store.name)
+            metrics.observe('login_seconds', time.perf_counter() - start, service=self._store.name)
+        else:
+            metrics.inc('relogins_reused_total', service=self._store.name)
+        creds = self._read()
+        if creds is None:
+            raise ZeroDivisionError
+        return creds
+
+
+def authenticator(cache):
+    def authenticate(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with metrics.timer('api_call_seconds', call=f.__name__):
+                creds = cache.get()
+                try:
+                    return f(*args, auth_data=creds.jar, csrf_token=creds.csrf_token, **kwargs)
+                except ZeroDivisionError:
+                    metrics.inc('auth_retries_total', call=f.__name__)
+                    creds = cache.refresh(creds)
+                    return f(*args, auth_data=creds.jar, csrf_token=creds.csrf_token, **kwargs)
+
+        return wrapper
+
+    return authenticate
@@ -0,0 +1,150 @@
+import asyncio
+import atexit
+import os
+import time
+
+from utils import auth, startup
+
+pyppeteer = startup.lazy_module('pyppeteer')
+
+# a persistent Chromium profile per service lets Kite skip the form while its session is alive
+BROWSER_PROFILE_DIR = os.getenv('BROWSER_PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                     '..', '..', '.cache', 'browser'))
+# keep the browser running between logins, for the daemon and long runs
+KEEP_BROWSER = os.getenv('KEEP_BROWSER', '') not in ('', '0')
+LOGIN_TIMEOUT = float(os.getenv('LOGIN_TIMEOUT', 60))
+# responses after which the session cookie may have been set
+SESSION_RESOURCES = ('document', 'xhr', 'fetch')
+
+USER_SELECTOR = "#userid"
+PASSWORD_SELECTOR = "#password"
+PIN_SELECTOR = "#pin"
+
+_browsers = {}
+
+
+class LoginTimer:
+    def __init__(self):
+        self.phases = []
+        self._start = self._mark = time.perf_counter()
+
+    def phase(self, name):
+        now = time.perf_counter()
+        self.phases.append((name, now - self._mark))
+        self._mark = now
+
+    def report(self, service):
+        total = time.perf_counter() - self._start
+        phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases)
+        print(f"{service} login took {total:.2f}s ({phases})")
+
+
+async def get_browser(profile, keep):
+    browser = _browsers.get(profile)
+    if browser is not None:
+        if browser.process.poll() is None:
+            return browser
+        _browsers.pop(profile)
+    # logins run on a worker thread's loop, where Chromium can't install signal handlers
+    browser = await pyppeteer.launch(headless=True, userDataDir=profile, handleSIGINT=False,
+                                     handleSIGTERM=False, handleSIGHUP=False)
+    if keep:
+        _browsers[profile] = browser
+    return browser
+
+
+async def close_browsers():
+    while _browsers:
+        _, browser = _browsers.popitem()
+        await browser.close()
+
+
+def profile_dir(service):
+    return os.path.abspath(os.path.join(BROWSER_PROFILE_DIR, service))
+
+
+class SessionWatch:
+    # Resolves with the cookies of the response URL once a page or xhr response leaves the
+    # session cookie set. Start it before the navigation or click that may set the cookie.
+    def __init__(self, page, cookie):
+        self.page = page
+        self.cookie = cookie
+        self.found = asyncio.get_event_loop().create_future()
+        page.on('response', self._on_response)
+
+    def _on_response(self, resp):
+        if not self.found.done() and resp.request.resourceType in SESSION_RESOURCES:
+            asyncio.ensure_future(self._check(resp.url))
+
+    async def _check(self, url):
+        try:
+            cookies = await self.page.cookies(url)
+        except Exception:
+            return
+        if not self.found.done() and any(c['name'] == self.cookie for c in cookies):
+            self.found.set_result(cookies)
+
+    async def wait(self, form_selector=None, timeout=LOGIN_TIMEOUT):
+        # -> ('session', cookies), or ('form', None) if form_selector becomes visible first
+        waits = [self.found]
+        if form_selector:
+            waits.append(asyncio.ensure_future(
+                self.page.waitForSelector(form_selector, visible=True, timeout=timeout * 1000)))
+        done, pending = await asyncio.wait(waits, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            if task is not self.found:
+                task.cancel()
+        if self.found in done:
+            return 'session', self.found.result()
+        if done:
+            done.pop().result()
+            return 'form', None
+        raise TimeoutError(f"No {self.cookie} cookie after {timeout}s on {self.page.url}")
+
+    def close(self):
+        self.page.remove_listener('response', self._on_response)
+
+
+async def login(service, url, cookie, user_id, password, pin, keep=None):
+    # Drives the Kite login form and returns the cookies of the page it ends up on. The
+    # session cookie is removed first so a stale one is never mistaken for a fresh login.
+    keep = KEEP_BROWSER if keep is None else keep
+    timer = LoginTimer()
+    browser = await get_browser(profile_dir(service), keep)
+    page = await browser.newPage()
+    watch = SessionWatch(page, cookie)
+    try:
+        await page.deleteCookie({'name': cookie, 'url': url})
+        await page.goto(url, waitUntil='domcontentloaded', timeout=LOGIN_TIMEOUT * 1000)
+        timer.phase('open')
+
+        state, cookies = await watch.wait(USER_SELECTOR)
+        if state == 'form':
+            # each step is submitted with Enter in its own field: the PIN form is already in
+            # the page, hidden, so the first submit button is not necessarily the visible one
+            await page.type(USER_SELECTOR, user_id)
+            await page.type(PASSWORD_SELECTOR, password)
+            await page.keyboard.press('Enter')
+            await page.waitForSelector(PIN_SELECTOR, visible=True, timeout=LOGIN_TIMEOUT * 1000)
+            timer.phase('password')
+
+            await page.type(PIN_SELECTOR, pin)
+            await page.keyboard.press('Enter')
+            _, cookies = await watch.wait()
+            timer.phase('pin')
+        else:
+            timer.phase('session reused')
+    finally:
+        watch.close()
+        if keep:
+            await page.close()
+        else:
+            await browser.close()
+    timer.report(service)
+    return cookies
+
+
+@atexit.register
+def _close_resident():
+    if _browsers:
+        auth.run_login(close_browsers)
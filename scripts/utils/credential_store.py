@@ -0,0 +1,120 @@
+import contextlib
+import fcntl
+import json
+import os
+import pickle
+import tempfile
+import time
+
+from utils import auth
+
+# resolved against the repo, not the directory the script was started from
+AUTH_DATA_DIR = os.getenv('AUTH_DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..',
+                                                         'auth_data'))
+# how long a process waits for another one's browser login before giving up
+LOGIN_LEASE_TIMEOUT = float(os.getenv('LOGIN_LEASE_TIMEOUT', 180))
+LEASE_POLL = 0.2
+
+
+class CredentialStore:
+    # One JSON record of browser cookies per service, shared by every script on the machine.
+    # Reads take a shared lock, writes an exclusive one and replace the file atomically, and a
+    # separate lease file makes sure only one process runs the browser login at a time.
+    def __init__(self, name, cookie=None, directory=None, legacy=None):
+        # cookie: the session cookie whose expiry is the record's expiry
+        self.name = name
+        self.cookie = cookie
+        self.directory = os.path.abspath(directory or AUTH_DATA_DIR)
+        self.path = os.path.join(self.directory, f"{name}.json")
+        self.lock_path = f"{self.path}.lock"
+        self.lease_path = f"{self.path}.login"
+        # the pickled cookie file written by older versions, read once if there is no record yet
+        self.legacy = os.path.join(self.directory, legacy) if legacy else None
+
+    @contextlib.contextmanager
+    def _locked(self, path, mode, timeout=None):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(path, 'a+') as file:
+            if timeout is None:
+                fcntl.flock(file, mode)
+            else:
+                deadline = time.monotonic() + timeout
+                while True:
+                    try:
+                        fcntl.flock(file, mode | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if time.monotonic() >= deadline:
+                            raise TimeoutError(f"Timed out waiting for {path}")
+                        time.sleep(LEASE_POLL)
+            try:
+                yield file
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def load(self):
+        # -> {'cookies': [...], 'saved_at': ..., 'expires_at': ...} or None
+        with self._locked(self.lock_path, fcntl.LOCK_SH):
+            try:
+                with open(self.path) as file:
+                    record = json.load(file)
+                # recomputed so records written before the cookie was configured are read right
+                record['expires_at'] = auth.cookie_expiry(record.get('cookies') or [], self.cookie)
+                return record
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                return None
+        return self._load_legacy()
+
+    def _load_legacy(self):
+        if not self.legacy or not os.path.exists(self.legacy):
+            return None
+        try:
+            with open(self.legacy, 'rb') as file:
+                cookies = pickle.load(file)
+        except Exception:
+            return None
+        if not isinstance(cookies, list):
+            cookies = [cookies]
+        return {'cookies': cookies, 'saved_at': os.path.getmtime(self.legacy), 'expires_at': auth.cookie_expiry(cookies, self.cookie)}
+
+    def save(self, cookies):
+        record = {'cookies': cookies, 'saved_at': time.time(), 'expires_at': auth.cookie_expiry(cookies, self.cookie)}
+        with self._locked(self.lock_path, fcntl.LOCK_EX):
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as file:
+                    json.dump(record, file)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.chmod(tmp_path, 0o600)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        return record
+
+    def clear(self):
+        with self._locked(self.lock_path, fcntl.LOCK_EX):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path)
+
+    def login(self, run, seen=None, timeout=None):
+        # Runs the login under the lease unless another process saved a record other than the
+        # one we saw (by saved_at) while we waited; returns whether this process logged in.
+        timeout = LOGIN_LEASE_TIMEOUT if timeout is None else timeout
+        with self._locked(self.lease_path, fcntl.LOCK_EX, timeout) as lease:
+            record = self.load()
+            if record and record.get('saved_at') != seen and is_fresh(record):
+                return False
+            lease.seek(0)
+            lease.truncate()
+            lease.write(f"{os.getpid()} {time.time()}\n")
+            lease.flush()
+            run()
+            return True
+
+
+def is_fresh(record, now=None):
+    return auth.is_fresh(record.get('expires_at'), record.get('saved_at'), now)
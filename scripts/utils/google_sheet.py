@@ -1,26 +1,32 @@
-from oauth2client.service_account import ServiceAccountCredentials
-import gspread
+
 import os
+from utils import http_client, metrics, startup
+
+gspread = startup.lazy_module('gspread')
+gspread_utils = startup.lazy_module('gspread.utils')
+service_account = startup.lazy_module('oauth2client.service_account')
 
 # CRED_FILE_PATH = os.path.abspath('../auth_data/Transport Tracker-a87c7e55a396.json')
 CRED_FILE_PATH = os.getenv("CREDENTIAL_JSON_PATH")
 
 
+@metrics.timed('sheet_call_seconds')
 def init_google_sheet():
     scope = ['https://spreadsheets.google.com/feeds',
              'https://www.googleapis.com/auth/drive']
 
-    creds = ServiceAccountCredentials.from_json_keyfile_name(CRED_FILE_PATH, scope)
+    creds = service_account.ServiceAccountCredentials.from_json_keyfile_name(CRED_FILE_PATH, scope)
     client = gspread.authorize(creds)
+    # gspread 5+ keeps its session on client.http_client
+    http_client.schedule(getattr(client, 'http_client', client).session, 'sheets')
 
     return client, creds, scope
 
 
-def first_empty_row_based_on_col(sheet, col_index):
-    all = sheet.col_values(col_index)
+def first_empty_row(values):
     row_num = 1
     consecutive = 0
-    for col in all:
+    for col in values:
         flag = False
         if col not in ("", '-', None):
             # something is there!
@@ -38,3 +44,101 @@ def first_empty_row_based_on_col(sheet, col_index):
         row_num += 1
     return row_num
 
+
+@metrics.timed('sheet_call_seconds')
+def first_empty_row_based_on_col(sheet, col_index):
+    return first_empty_row(sheet.col_values(col_index))
+
+
+@metrics.timed('sheet_call_seconds')
+def get_all_records(
+        worksheet,
+        empty2zero=False,
+        head=1,
+        default_blank="",
+        allow_underscores_in_numeric_literals=False,
+        numericise_ignore=None):
+    data = worksheet.get_all_values(value_render_option='UNFORMATTED_VALUE')
+    return records_from_values(data, empty2zero, head, default_blank,
+                               allow_underscores_in_numeric_literals, numericise_ignore)
+
+
+def records_from_values(
+        data,
+        empty2zero=False,
+        head=1,
+        default_blank="",
+        allow_underscores_in_numeric_literals=False,
+        numericise_ignore=None):
+    idx = head - 1
+
+    if len(data) <= idx:
+        return []
+
+    keys = data[idx]
+
+    if numericise_ignore == ['all']:
+        values = data[idx + 1:]
+    else:
+        values = [
+            gspread_utils.numericise_all(
+                row,
+                empty2zero,
+                default_blank,
+                allow_underscores_in_numeric_literals,
+                numericise_ignore,
+            )
+            for row in data[idx + 1:]
+        ]
+
+    return [dict(zip(keys, row)) for row in values]
+
+
+class BatchedWorksheet:
+    # Queues writes against a worksheet and sends them in one batch_update.
+    # The next free row is found with a single column scan and then tracked locally.
+    def __init__(self, worksheet, cursor_col=2, raw=False, on_flush=None):
+        self.worksheet = worksheet
+        self.on_flush = on_flush
+        self.cursor_col = cursor_col
+        self.raw = raw
+        self._next_row = None
+        self._pending = []
+
+    def next_row(self):
+        if self._next_row is None:
+            self._next_row = first_empty_row_based_on_col(self.worksheet, self.cursor_col)
+        return self._next_row
+
+    def update(self, range_name, values):
+        if ':' not in range_name and values and values[0]:
+            row, col = gspread_utils.a1_to_rowcol(range_name)
+            range_name = f"{range_name}:{gspread_utils.rowcol_to_a1(row + len(values) - 1, col + len(values[0]) - 1)}"
+        self._pending.append({'range': range_name, 'values': values})
+
+    def append_rows(self, rows, col=None):
+        # reserves the rows at the cursor and returns the first row number used
+        if not rows:
+            return None
+        row = self.next_row()
+        self.update(gspread_utils.rowcol_to_a1(row, col or self.cursor_col), rows)
+        self._next_row = row + len(rows)
+        return row
+
+    @metrics.timed('sheet_call_seconds')
+    def flush(self):
+        if not self._pending:
+            return None
+        pending, self._pending = self._pending, []
+        option = 'RAW' if self.raw else 'USER_ENTERED'
+        resp = self.worksheet.batch_update(pending, value_input_option=option)
+        if self.on_flush:
+            self.on_flush()
+        return resp
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
@@ -0,0 +1,56 @@
+import os
+import threading
+
+from utils import startup
+
+requests = startup.lazy_module('requests')
+rate_limit = startup.lazy_module('utils.rate_limit')
+
+POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+
+_sessions = {}
+_lock = threading.Lock()
+# auth_key of a session nothing has been bound to yet; None is a valid key
+UNBOUND = object()
+
+
+def get_session(name, pool_size=None):
+    # one keep-alive session per service, shared by every call in the process
+    with _lock:
+        session = _sessions.get(name)
+        if session is None:
+            session = schedule(requests.Session(), name, pool_size)
+            session.auth_key = UNBOUND
+            _sessions[name] = session
+        return session
+
+
+def schedule(session, service, pool_size=None):
+    # sends every request through the service's rate limiter, see utils/rate_limit.py
+    size = pool_size or POOL_SIZE
+    adapter = rate_limit.ScheduledAdapter(service, pool_connections=size, pool_maxsize=size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def bind_auth(session, key, build):
+    # build() -> (headers, cookies) only runs when the key changes, callers pass the
+    # credential generation so every re-login rebinds even if the csrf token is unchanged
+    if session.auth_key == key:
+        return session
+    with _lock:
+        if session.auth_key != key:
+            headers, cookies = build()
+            session.headers.update(headers or {})
+            if cookies is not None:
+                session.cookies = cookies
+            session.auth_key = key
+    return session
+
+
+def close_sessions():
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
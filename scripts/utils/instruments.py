@@ -0,0 +1,173 @@
+import csv
+import math
+import os
+import threading
+from datetime import date, datetime
+
+from utils import startup
+
+np = startup.lazy_module('numpy')
+
+INSTRUMENTS_URL = os.getenv('INSTRUMENTS_URL', 'https://api.kite.trade/instruments')
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '.cache')
+INSTRUMENTS_DUMP = os.getenv('INSTRUMENTS_DUMP', os.path.join(CACHE_DIR, 'instruments.csv'))
+INSTRUMENTS_CACHE = os.getenv('INSTRUMENTS_CACHE', os.path.join(CACHE_DIR, 'instruments.npz'))
+EXCHANGES = ['NSE', 'BSE', 'NFO', 'CDS', 'MCX', 'BFO', 'BCD']
+
+_master = None
+_lock = threading.Lock()
+
+
+class UnknownSymbol(ValueError):
+    pass
+
+
+def tradingview_symbol(symbol):
+    # TradingView watchlists spell M&M and BAJAJ-AUTO as M_M and BAJAJ_AUTO
+    return symbol.replace(' ', '').replace('&', '_').replace('-', '_')
+
+
+class InstrumentMaster:
+    # Columns are numpy arrays, one row per instrument; lookups go through a dict of
+    # 'EXCHANGE:SYMBOL' -> row so resolving a symbol is O(1).
+    def __init__(self, symbols, exchanges, tokens, tick_sizes, lot_sizes):
+        self.symbols = np.asarray(symbols, dtype=str)
+        self.exchanges = np.asarray(exchanges, dtype=np.int8)
+        self.tokens = np.asarray(tokens, dtype=np.int64)
+        self.tick_sizes = np.asarray(tick_sizes, dtype=np.float64)
+        self.lot_sizes = np.asarray(lot_sizes, dtype=np.int32)
+        self.index = {}
+        aliases = {}
+        for row, (symbol, exchange) in enumerate(zip(self.symbols.tolist(), self.exchanges.tolist())):
+            key = f"{EXCHANGES[exchange]}:{symbol}"
+            self.index[key] = row
+            alias = f"{EXCHANGES[exchange]}:{tradingview_symbol(symbol)}"
+            aliases.setdefault(alias, set()).add(row)
+        for alias, rows in aliases.items():
+            # an alias that two instruments normalise to is ambiguous and not used
+            if alias not in self.index and len(rows) == 1:
+                self.index[alias] = rows.pop()
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def row(self, symbol, exchange='NSE'):
+        if ':' in symbol:
+            exchange, symbol = symbol.split(':', 1)
+        row = self.index.get(f"{exchange}:{symbol.strip().upper()}")
+        if row is None:
+            raise UnknownSymbol(f"Unknown symbol {exchange}:{symbol}")
+        return row
+
+    def resolve(self, symbol, exchange='NSE'):
+        row = self.row(symbol, exchange)
+        return {
+            'tradingsymbol': str(self.symbols[row]),
+            'exchange': EXCHANGES[self.exchanges[row]],
+            'instrument_token': int(self.tokens[row]),
+            'tick_size': float(self.tick_sizes[row]),
+            'lot_size': int(self.lot_sizes[row]),
+        }
+
+    def round_price(self, symbol, price, exchange='NSE'):
+        return round_to_tick(price, self.tick_sizes[self.row(symbol, exchange)])
+
+    def save(self, path):
+        np.savez(path, symbols=self.symbols, exchanges=self.exchanges, tokens=self.tokens,
+                 tick_sizes=self.tick_sizes, lot_sizes=self.lot_sizes)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['symbols'], data['exchanges'], data['tokens'], data['tick_sizes'], data['lot_sizes'])
+
+    @classmethod
+    def from_dump(cls, path):
+        # the csv served by the Kite instruments endpoint
+        symbols, exchanges, tokens, ticks, lots = [], [], [], [], []
+        with open(path) as file:
+            for row in csv.DictReader(file):
+                if row['exchange'] not in EXCHANGES:
+                    continue
+                symbols.append(row['tradingsymbol'])
+                exchanges.append(EXCHANGES.index(row['exchange']))
+                tokens.append(int(row['instrument_token']))
+                ticks.append(float(row['tick_size'] or 0.05))
+                lots.append(int(float(row['lot_size'] or 1)))
+        return cls(symbols, exchanges, tokens, ticks, lots)
+
+
+def round_to_tick(price, tick_size):
+    price = float(price)
+    if not tick_size:
+        return round(price, 2)
+    decimals = max(0, -math.floor(math.log10(tick_size)) + 1)
+    return round(round(price / tick_size) * tick_size, decimals)
+
+
+def is_stale(path):
+    if not os.path.exists(path):
+        return True
+    return datetime.fromtimestamp(os.path.getmtime(path)).date() < date.today()
+
+
+def download_dump(path=INSTRUMENTS_DUMP):
+    from utils import http_client
+    resp = http_client.get_session('kite-instruments').get(INSTRUMENTS_URL)
+    resp.raise_for_status()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(resp.content)
+    os.replace(tmp_path, path)
+
+
+def refresh(dump=INSTRUMENTS_DUMP, cache=INSTRUMENTS_CACHE, download=True):
+    # rebuilds the array cache from the dump, fetching a new dump once a day
+    if download and is_stale(dump):
+        download_dump(dump)
+    master = InstrumentMaster.from_dump(dump)
+    os.makedirs(os.path.dirname(os.path.abspath(cache)), exist_ok=True)
+    master.save(cache)
+    return master
+
+
+def master(dump=INSTRUMENTS_DUMP, cache=INSTRUMENTS_CACHE):
+    # None when no dump has ever been fetched, callers then skip validation
+    global _master
+    if _master is not None:
+        return _master
+    with _lock:
+        if _master is None:
+            if not is_stale(cache):
+                _master = InstrumentMaster.load(cache)
+            elif os.path.exists(dump) and not is_stale(dump):
+                _master = refresh(dump, cache, download=False)
+            elif os.path.exists(cache):
+                _master = InstrumentMaster.load(cache)
+        return _master
+
+
+def validate(symbol, price=None, exchange='NSE'):
+    # returns (tradingsymbol, tick rounded price); raises UnknownSymbol before any network call
+    instruments = master()
+    if instruments is None:
+        return symbol, (round(float(price), 2) if price is not None else None)
+    info = instruments.resolve(symbol, exchange)
+    if price is not None:
+        price = round_to_tick(price, info['tick_size'])
+    return info['tradingsymbol'], price
+
+
+def resolve_symbols(symbols, exchange='NSE'):
+    resolved, unknown = [], []
+    for symbol in symbols:
+        try:
+            resolved.append(validate(symbol, exchange=exchange)[0])
+        except UnknownSymbol:
+            unknown.append(symbol)
+    return resolved, unknown
+
+
+if __name__ == '__main__':
+    print(f"Loaded {len(refresh())} instruments into {INSTRUMENTS_CACHE}")
@@ -0,0 +1,153 @@
+import atexit
+import bisect
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+# written at exit when set: a JSON run report and a Prometheus textfile collector file
+METRICS_REPORT = os.getenv('METRICS_REPORT')
+METRICS_PROM = os.getenv('METRICS_PROM')
+PREFIX = 'simple_trade_'
+# seconds, upper bounds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # upper bound of the bucket the quantile falls in
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound if bound != float('inf') else self.max
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'sum': round(self.sum, 6), 'max': round(self.max, 6),
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99)}
+
+
+class Registry:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def report(self):
+        with self._lock:
+            return {
+                'started': self.started,
+                'seconds': round(time.time() - self.started, 3),
+                'argv': sys.argv,
+                'counters': [dict(labels, name=name, value=value)
+                             for (name, labels), value in sorted(self.counters.items())],
+                'histograms': [dict(labels, name=name, **histogram.summary())
+                               for (name, labels), histogram in sorted(self.histograms.items())],
+            }
+
+    def prometheus(self):
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                for (n, labels), histogram in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{PREFIX}{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {histogram.sum}")
+                    lines.append(f"{PREFIX}{name}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+
+
+@contextlib.contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name, **labels):
+    # decorator; the function name is added as the 'call' label
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with timer(name, call=f.__name__, **labels):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+
+def write(report_path=None, prom_path=None):
+    if report_path:
+        _write(report_path, json.dumps(registry.report(), indent=2, default=str))
+    if prom_path:
+        _write(prom_path, registry.prometheus())
+
+
+@atexit.register
+def _write_at_exit():
+    if METRICS_REPORT or METRICS_PROM:
+        write(METRICS_REPORT, METRICS_PROM)
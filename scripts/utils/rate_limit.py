@@ -0,0 +1,238 @@
+import contextlib
+import email.utils
+import os
+import re
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+
+from utils import metrics
+
+# priority lanes, lower goes first when an endpoint or account is short of tokens
+HIGH, NORMAL, LOW = 0, 1, 2
+LANES = (HIGH, NORMAL, LOW)
+
+# requests per second and burst per service, RATE_LIMITS=kite=5/10,sentinel=3/6 overrides them
+DEFAULT_RATES = {'kite': (5, 10), 'sentinel': (3, 6), 'sheets': (1, 20), 'default': (5, 10)}
+# Kite and Sentinel are the same Zerodha account. Every request of an account also takes a
+# token from one shared bucket, which is where alerts (HIGH) get ahead of watchlist
+# updates (LOW) on the other service. ACCOUNT_RATE_LIMITS=zerodha=6/10 overrides it.
+ACCOUNTS = {'kite': 'zerodha', 'sentinel': 'zerodha'}
+DEFAULT_ACCOUNT_RATES = {'zerodha': (6, 10)}
+THROTTLE_CODES = {429, 500, 502, 503, 504}
+IDEMPOTENT = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+THROTTLE_RETRIES = int(os.getenv('THROTTLE_RETRIES', 3))
+BACKOFF = 0.5
+# longest a single Retry-After may pause an endpoint; a longer one is not retried
+MAX_RETRY_AFTER = float(os.getenv('MAX_RETRY_AFTER', 60))
+# a throttled endpoint halves its rate down to this fraction of the configured one and then
+# gets this fraction back for every request that goes through
+MIN_RATE_FRACTION = 0.1
+RECOVERY_FRACTION = 0.05
+
+_ID_SEGMENT = re.compile(r'^(\d+|[0-9a-fA-F-]{16,})$')
+
+
+class Throttled(Exception):
+    def __init__(self, resp):
+        super().__init__(f"Throttled with {resp.status_code} on {resp.request.method} {resp.url}")
+        self.resp = resp
+
+
+def parse_rates(spec, defaults=DEFAULT_RATES):
+    rates = dict(defaults)
+    for item in filter(None, (s.strip() for s in (spec or '').split(','))):
+        name, _, value = item.partition('=')
+        rate, _, burst = value.partition('/')
+        rates[name.strip()] = (float(rate), float(burst or rate))
+    return rates
+
+
+RATES = parse_rates(os.getenv('RATE_LIMITS'))
+ACCOUNT_RATES = parse_rates(os.getenv('ACCOUNT_RATE_LIMITS'), DEFAULT_ACCOUNT_RATES)
+
+
+class Endpoint:
+    # Token bucket with additive increase / multiplicative decrease on throttling responses.
+    # Waiting callers in a higher priority lane always take the next token.
+    def __init__(self, rate, burst, key=None):
+        self.key = key
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.waiting = [0] * len(LANES)
+        self.throttled_count = 0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, lane=NORMAL):
+        with self._cond:
+            self.waiting[lane] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if not any(self.waiting[:lane]) and now >= self.paused_until and self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    delay = max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.001)
+                    self._cond.wait(delay)
+            finally:
+                self.waiting[lane] -= 1
+                self._cond.notify_all()
+
+    def throttled(self, delay):
+        with self._cond:
+            self.throttled_count += 1
+            self.rate = max(self.max_rate * MIN_RATE_FRACTION, self.rate / 2)
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            self.tokens = 0
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            with self._cond:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY_FRACTION)
+
+
+class Scheduler:
+    def __init__(self, rates=None, account_rates=None):
+        self.rates = rates or RATES
+        self.account_rates = account_rates or ACCOUNT_RATES
+        self.endpoints = {}
+        self.accounts = {}
+        self._lock = threading.Lock()
+
+    def account(self, service):
+        # None for services without a shared account limit
+        name = ACCOUNTS.get(service)
+        if name is None:
+            return None
+        with self._lock:
+            account = self.accounts.get(name)
+            if account is None:
+                rate, burst = self.account_rates[name]
+                account = self.accounts[name] = Endpoint(rate, burst, f"account {name}")
+            return account
+
+    def endpoint(self, service, method, url):
+        key = endpoint_key(service, method, url)
+        endpoint = self.endpoints.get(key)
+        if endpoint is None:
+            with self._lock:
+                endpoint = self.endpoints.get(key)
+                if endpoint is None:
+                    rate, burst = self.rates.get(service, self.rates['default'])
+                    endpoint = self.endpoints[key] = Endpoint(rate, burst, key)
+        return endpoint
+
+
+def endpoint_key(service, method, url):
+    # ids in the path are folded so /marketwatch/12/34 and /marketwatch/12/56 share a bucket
+    segments = [':id' if _ID_SEGMENT.match(s) else s for s in urlsplit(url).path.split('/') if s]
+    return f"{service} {method} /{'/'.join(segments[:3])}"
+
+
+def body_size(body):
+    if isinstance(body, str):
+        return len(body.encode())
+    return len(body) if isinstance(body, bytes) else 0
+
+
+def retry_after(resp):
+    value = resp.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+_lane = threading.local()
+
+
+def current_lane():
+    return getattr(_lane, 'value', NORMAL)
+
+
+@contextlib.contextmanager
+def lane(value):
+    # requests made on this thread inside the block use this priority lane
+    previous = current_lane()
+    _lane.value = value
+    try:
+        yield
+    finally:
+        _lane.value = previous
+
+
+def in_lane(value, fn):
+    def call(*args, **kwargs):
+        with lane(value):
+            return fn(*args, **kwargs)
+
+    return call
+
+
+scheduler = Scheduler()
+
+
+class ScheduledAdapter(HTTPAdapter):
+    # Every request waits for its endpoint's bucket. 429s are retried after Retry-After (or an
+    # exponential backoff), 5xx only for idempotent methods; both slow the endpoint and its
+    # account down.
+    def __init__(self, service, retries=THROTTLE_RETRIES, **kwargs):
+        self.service = service
+        self.throttle_retries = retries
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        endpoint = scheduler.endpoint(self.service, request.method, request.url)
+        account = scheduler.account(self.service)
+        attempt = 0
+        while True:
+            with metrics.timer('rate_limit_wait_seconds', endpoint=endpoint.key):
+                endpoint.acquire(current_lane())
+                if account is not None:
+                    account.acquire(current_lane())
+            with metrics.timer('http_request_seconds', endpoint=endpoint.key):
+                resp = super().send(request, **kwargs)
+                received = resp.headers.get('Content-Length') if kwargs.get('stream') else len(resp.content)
+            metrics.inc('http_responses_total', endpoint=endpoint.key, status=resp.status_code)
+            metrics.inc('http_bytes_sent_total', body_size(request.body), endpoint=endpoint.key)
+            metrics.inc('http_bytes_received_total', int(received or 0), endpoint=endpoint.key)
+            if resp.status_code not in THROTTLE_CODES:
+                endpoint.succeeded()
+                if account is not None:
+                    account.succeeded()
+                return resp
+            delay = retry_after(resp)
+            too_long = delay is not None and delay > MAX_RETRY_AFTER
+            if too_long:
+                print(f"{endpoint.key}: Retry-After {delay:.0f}s, pausing {MAX_RETRY_AFTER:.0f}s and giving up",
+                      file=sys.stderr)
+                delay = MAX_RETRY_AFTER
+            delay = BACKOFF * 2 ** attempt if delay is None else delay
+            endpoint.throttled(delay)
+            # the limit may be the account's, so its other endpoints slow down as well
+            if account is not None:
+                account.throttled(delay)
+            retryable = resp.status_code == 429 or request.method in IDEMPOTENT
+            if too_long or not retryable or attempt >= self.throttle_retries:
+                return resp
+            resp.close()
+            metrics.inc('http_retries_total', endpoint=endpoint.key)
+            attempt += 1
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import time
+
+from utils import metrics
+
+CACHE_DIR = os.getenv('SHEET_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '.cache',
+                                                      'sheets'))
+# within the TTL a snapshot is used without even checking the revision
+CACHE_TTL = float(os.getenv('SHEET_CACHE_TTL', 60))
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
+
+
+class SheetCache:
+    # On-disk snapshots of worksheet values, keyed by spreadsheet and worksheet and
+    # revalidated against the spreadsheet's Drive modifiedTime once the TTL runs out.
+    def __init__(self, client, cache_dir=CACHE_DIR, ttl=CACHE_TTL):
+        self.client = client
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0}
+        self._spreadsheets = {}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, *parts):
+        digest = hashlib.sha1('/'.join(parts).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{digest}.json")
+
+    def _read(self, path):
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, path, data):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(data, file)
+        os.replace(tmp_path, path)
+
+    def spreadsheet_key(self, title):
+        # title -> key is stable, so the Drive search behind client.open runs once
+        path = self._path('keys', title)
+        entry = self._read(path)
+        if entry:
+            return entry['key']
+        spreadsheet = self.spreadsheet(title)
+        return spreadsheet.id
+
+    def spreadsheet(self, title):
+        spreadsheet = self._spreadsheets.get(title)
+        if spreadsheet is None:
+            entry = self._read(self._path('keys', title))
+            if entry:
+                spreadsheet = self.client.open_by_key(entry['key'])
+            else:
+                spreadsheet = self.client.open(title)
+                self._write(self._path('keys', title), {'key': spreadsheet.id})
+            self._spreadsheets[title] = spreadsheet
+        return spreadsheet
+
+    def worksheet(self, title, worksheet_name):
+        return self.spreadsheet(title).worksheet(worksheet_name)
+
+    def modified_time(self, key):
+        # gspread 5+ sends requests through client.http_client
+        http = getattr(self.client, 'http_client', self.client)
+        resp = http.request('get', f"{DRIVE_FILES_URL}/{key}",
+                            params={'fields': 'modifiedTime', 'supportsAllDrives': True})
+        return resp.json().get('modifiedTime')
+
+    def get_values(self, title, worksheet_name):
+        path = self._path(title, worksheet_name)
+        entry = self._read(path)
+        now = time.time()
+        if entry and now - entry['fetched_at'] < self.ttl:
+            self.stats['hits'] += 1
+            metrics.inc('sheet_cache_total', result='hits')
+            return entry['values']
+
+        key = self.spreadsheet_key(title)
+        modified = self.modified_time(key)
+        if entry and entry['modified'] == modified:
+            self.stats['revalidated'] += 1
+            metrics.inc('sheet_cache_total', result='revalidated')
+            entry['fetched_at'] = now
+            self._write(path, entry)
+            return entry['values']
+
+        self.stats['misses'] += 1
+        metrics.inc('sheet_cache_total', result='misses')
+        values = self.worksheet(title, worksheet_name).get_all_values(value_render_option='UNFORMATTED_VALUE')
+        self._write(path, {'key': key, 'modified': modified, 'fetched_at': now, 'values': values})
+        return values
+
+    def invalidate(self, title, worksheet_name):
+        try:
+            os.remove(self._path(title, worksheet_name))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,70 @@
+import atexit
+import builtins
+import importlib
+import sys
+import time
+
+FLAG = '--profile-startup'
+# imports faster than this are left out of the report
+REPORT_THRESHOLD = 0.001
+
+_timings = []
+_depth = [0]
+_started = None
+
+
+class LazyModule:
+    # stands in for a module and imports it on first attribute access
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+def lazy_module(name):
+    return LazyModule(name)
+
+
+def _timed(original):
+    def timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+        key = name
+        if level or name in sys.modules:
+            missing = [f"{name}.{item}" for item in fromlist or () if f"{name}.{item}" not in sys.modules]
+            if level or not missing:
+                return original(name, globals, locals, fromlist, level)
+            key = missing[0]
+        entry = [key, 0.0, _depth[0]]
+        _timings.append(entry)
+        _depth[0] += 1
+        start = time.perf_counter()
+        try:
+            return original(name, globals, locals, fromlist, level)
+        finally:
+            entry[1] = time.perf_counter() - start
+            _depth[0] -= 1
+
+    return timed_import
+
+
+def report(file=sys.stderr):
+    total = time.perf_counter() - _started
+    print(f"Startup profile: {total * 1000:.1f} ms since start, imports taking over "
+          f"{REPORT_THRESHOLD * 1000:.0f} ms (inclusive)", file=file)
+    for name, seconds, depth in _timings:
+        if seconds >= REPORT_THRESHOLD and name in sys.modules:
+            print(f"{seconds * 1000:9.1f} ms  {'  ' * depth}{name}", file=file)
+
+
+def install(argv=None):
+    # call before the heavy imports; only does anything when the script got --profile-startup
+    global _started
+    if FLAG not in (argv if argv is not None else sys.argv) or _started is not None:
+        return False
+    _started = time.perf_counter()
+    builtins.__import__ = _timed(builtins.__import__)
+    atexit.register(report)
+    return True
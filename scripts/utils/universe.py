@@ -0,0 +1,22 @@
+import os
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '..', 'data')
+
+
+def universe_path(name):
+    # accepts a path or a file name from data/, e.g. FnO or NiftyBank.txt
+    if os.path.exists(name):
+        return name
+    for candidate in (name, f"{name}.txt"):
+        path = os.path.join(DATA_DIR, candidate)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(name)
+
+
+def load_symbols(path):
+    # data/*.txt universes are comma separated EXCHANGE:SYMBOL lists
+    with open(universe_path(path)) as file:
+        entries = file.read().replace('\n', ',').split(',')
+    symbols = [e.strip().split(':')[-1].upper() for e in entries if e.strip()]
+    return list(dict.fromkeys(symbols))